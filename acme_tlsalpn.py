@@ -15,14 +15,57 @@
 # limitations under the License.
 
 import binascii
+import collections
+import concurrent.futures
+import datetime
+import ipaddress
 import os
+import selectors
 import socket
 import socketserver
 import threading
+import time
+import traceback
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, ed448, ed25519
 
 from OpenSSL import crypto
 from OpenSSL import SSL
 
+from challenge_store import ChallengeStore
+from metrics import REGISTRY
+
+
+TLS_HANDSHAKES = REGISTRY.counter('acme_tls_alpn_handshakes_total', 'TLS-ALPN handshakes', ('result', ))
+TLS_HANDSHAKE_SECONDS = REGISTRY.histogram('acme_tls_alpn_handshake_seconds', 'Duration of TLS-ALPN handshakes', ('result', ))
+TLS_HANDSHAKES_IN_PROGRESS = REGISTRY.gauge('acme_tls_alpn_handshakes_in_progress', 'TLS-ALPN handshakes currently running')
+
+# Validity period of the self-signed certificates created by gen_ss_cert()
+CERTIFICATE_LIFETIME = datetime.timedelta(days=1)
+
+
+def make_context(method, key=None, cert=None, alpn_selection=None, servername_callback=None):
+    """Create an `OpenSSL.SSL.Context` with SSLv2 and SSLv3 disabled.
+
+    Keys and certificates are parsed once here; the context can then be
+    shared by any number of connections.
+
+    """
+    context = SSL.Context(method)
+    context.set_options(SSL.OP_NO_SSLv2)
+    context.set_options(SSL.OP_NO_SSLv3)
+    if key is not None:
+        context.use_privatekey(key)
+    if cert is not None:
+        context.use_certificate(cert)
+    if servername_callback is not None:
+        context.set_tlsext_servername_callback(servername_callback)
+    if alpn_selection is not None:
+        context.set_alpn_select_callback(alpn_selection)
+    return context
+
 
 class _DefaultCertSelection(object):
     def __init__(self, certs):
@@ -43,12 +86,20 @@ class SSLSocket(object):
         connection.
     :ivar cert_selection: Hook to select certificate for connection. If given,
         `certs` parameter would be ignored, and therefore must be empty.
+        The hook returns either a ``(key, cert)`` pair or a ready-made
+        `OpenSSL.SSL.Context`.
+    :ivar bool handshake_on_accept: Whether `accept` performs the handshake.
+        If not, the caller must call `handshake` on the returned connection.
+    :ivar handshake_timeout: Seconds a handshake may take, or ``None``.
 
     """
-    def __init__(self, sock, log_callback, certs=None, alpn_selection=None, cert_selection=None):
+    def __init__(self, sock, log_callback, certs=None, alpn_selection=None, cert_selection=None,
+                 handshake_on_accept=True, handshake_timeout=None):
         self.sock = sock
         self.log_callback = log_callback
         self.alpn_selection = alpn_selection
+        self.handshake_on_accept = handshake_on_accept
+        self.handshake_timeout = handshake_timeout
         self.method = SSL.SSLv23_METHOD
         if not cert_selection and not certs:
             raise ValueError("Neither cert_selection or certs specified.")
@@ -57,6 +108,7 @@ class SSLSocket(object):
         if cert_selection is None:
             cert_selection = _DefaultCertSelection(certs)
         self.cert_selection = cert_selection
+        self.context = make_context(self.method, alpn_selection=alpn_selection, servername_callback=self._pick_certificate_cb)
 
     def __getattr__(self, name):
         return getattr(self.sock, name)
@@ -73,19 +125,14 @@ class SSLSocket(object):
         :type connection: :class:`OpenSSL.Connection`
 
         """
-        pair = self.cert_selection(connection)
-        if pair is None:
+        selection = self.cert_selection(connection)
+        if selection is None:
             self.log_callback("SSL Socket: Certificate selection for server name {0} failed, dropping SSL".format(connection.get_servername()))
             return
-        key, cert = pair
-        new_context = SSL.Context(self.method)
-        new_context.set_options(SSL.OP_NO_SSLv2)
-        new_context.set_options(SSL.OP_NO_SSLv3)
-        new_context.use_privatekey(key)
-        new_context.use_certificate(cert)
-        if self.alpn_selection is not None:
-            new_context.set_alpn_select_callback(self.alpn_selection)
-        connection.set_context(new_context)
+        if not isinstance(selection, SSL.Context):
+            key, cert = selection
+            selection = make_context(self.method, key=key, cert=cert, alpn_selection=self.alpn_selection)
+        connection.set_context(selection)
 
     class FakeConnection(object):
         """Fake OpenSSL.SSL.Connection."""
@@ -111,23 +158,65 @@ class SSLSocket(object):
 
     def accept(self):  # pylint: disable=missing-docstring
         sock, addr = self.sock.accept()
-        context = SSL.Context(self.method)
-        context.set_options(SSL.OP_NO_SSLv2)
-        context.set_options(SSL.OP_NO_SSLv3)
-        context.set_tlsext_servername_callback(self._pick_certificate_cb)
-        if self.alpn_selection is not None:
-            context.set_alpn_select_callback(self.alpn_selection)
-        ssl_sock = self.FakeConnection(SSL.Connection(context, sock))
+        ssl_sock = self.FakeConnection(SSL.Connection(self.context, sock))
         ssl_sock.set_accept_state()
+        if self.handshake_on_accept:
+            try:
+                self.handshake(ssl_sock, addr)
+            except socket.error:
+                # socketserver ignores OSError from get_request() and keeps serving
+                sock.close()
+                raise
+        return ssl_sock, addr
+
+    def _wait_for_socket(self, connection, writable, deadline):
+        if deadline is None:
+            timeout = None
+        else:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                raise socket.timeout('handshake timed out')
+        # Unlike select.select(), selectors also work for file descriptors >= FD_SETSIZE
+        with selectors.DefaultSelector() as selector:
+            selector.register(connection.fileno(), selectors.EVENT_WRITE if writable else selectors.EVENT_READ)
+            ready = selector.select(timeout)
+        if not ready:
+            raise socket.timeout('handshake timed out')
+
+    def handshake(self, ssl_sock, addr):
+        """Perform the server side handshake of an accepted connection.
+
+        Raises `socket.error` if the handshake fails (including ALPN
+        negotiation) or takes longer than `handshake_timeout`.
+
+        """
         self.log_callback("SSL Socket: Performing handshake with {0}".format(addr))
+        start = time.monotonic()
+        deadline = None if self.handshake_timeout is None else start + self.handshake_timeout
+        if deadline is not None:
+            ssl_sock.setblocking(False)
         try:
-            ssl_sock.do_handshake()
-        except SSL.Error as error:
+            while True:
+                try:
+                    ssl_sock.do_handshake()
+                    break
+                except SSL.WantReadError:
+                    self._wait_for_socket(ssl_sock, False, deadline)
+                except SSL.WantWriteError:
+                    self._wait_for_socket(ssl_sock, True, deadline)
+        except (SSL.Error, socket.error, BadALPNProtos) as error:
+            # BadALPNProtos is raised by the ALPN selection callback when the
+            # client does not offer acme-tls/1
+            TLS_HANDSHAKES.inc(result='failure')
+            TLS_HANDSHAKE_SECONDS.observe(time.monotonic() - start, result='failure')
             # _pick_certificate_cb might have returned without
             # creating SSL context (wrong server name)
             raise socket.error(error)
-
-        return ssl_sock, addr
+        finally:
+            if deadline is not None:
+                ssl_sock.setblocking(True)
+        TLS_HANDSHAKES.inc(result='success')
+        TLS_HANDSHAKE_SECONDS.observe(time.monotonic() - start, result='success')
 
 
 class BaseRequestHandlerWithLogging(socketserver.BaseRequestHandler):
@@ -151,19 +240,102 @@ class BadALPNProtos(Exception):
     pass
 
 
-class TLSALPN01Server(socketserver.TCPServer):
+class ACMEALPNSelection(object):
+    """Callback to select alpn protocol.
+
+    Only accepts clients which offer exactly ``acme-tls/1``.
+
+    """
     ACME_TLS_1_PROTOCOL = b"acme-tls/1"
 
-    def __init__(self, server_address, certs, challenge_certs, log_callback):
+    def __init__(self, log_callback):
+        self.log_callback = log_callback
+
+    def __call__(self, _connection, alpn_protos):
+        if len(alpn_protos) == 1 and alpn_protos[0] == self.ACME_TLS_1_PROTOCOL:
+            self.log_callback("TLS ALPN Challenge server: Agreed on {0} ALPN".format(self.ACME_TLS_1_PROTOCOL))
+            return self.ACME_TLS_1_PROTOCOL
+        # Raising an exception causes openssl to terminate handshake and
+        # send fatal tls alert.
+        self.log_callback("TLS ALPN Challenge server: Cannot agree on ALPN proto. Got: {0}".format(alpn_protos))
+        raise BadALPNProtos("Got: {0}".format(alpn_protos))
+
+
+class TLSALPN01Server(socketserver.TCPServer):
+    """TLS-ALPN-01 challenge server.
+
+    With ``handshake_workers`` set to 0, handshakes run inline in the accept
+    loop. Otherwise, accepted connections are handed to a pool of that many
+    threads which run the handshake and the request handler, so that a slow
+    client does not hold up others. If all workers are busy, the accept loop
+    waits for one to become free and new connections queue up in the listen
+    backlog.
+
+    """
+    ACME_TLS_1_PROTOCOL = ACMEALPNSelection.ACME_TLS_1_PROTOCOL
+
+    def __init__(self, server_address, challenges, log_callback, alpn_selection=None,
+                 handshake_workers=0, handshake_timeout=None):
         self.ipv6 = False
         self.address_family = socket.AF_INET
-        self.certs = certs
-        self.challenge_certs = challenge_certs
+        self.challenges = challenges
         self.allow_reuse_address = True
         self.log_callback = log_callback
+        self.alpn_selection = alpn_selection or ACMEALPNSelection(log_callback)
+        self.handshake_workers = handshake_workers
+        self.handshake_timeout = handshake_timeout
+        self._executor = None
+        self._worker_slots = None
+        self._active_lock = threading.Lock()
+        self._active = 0
+        if handshake_workers > 0:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=handshake_workers, thread_name_prefix='tls-alpn-handshake')
+            self._worker_slots = threading.BoundedSemaphore(handshake_workers)
         BaseRequestHandlerWithLogging.log_callback.append(log_callback)  # Ugly hack, but works...
         super(TLSALPN01Server, self).__init__(server_address, BaseRequestHandlerWithLogging)
 
+    def _count_active(self, delta):
+        with self._active_lock:
+            self._active += delta
+            TLS_HANDSHAKES_IN_PROGRESS.set(self._active)
+
+    def process_request(self, request, client_address):
+        if self._executor is None:
+            return super(TLSALPN01Server, self).process_request(request, client_address)
+        self._worker_slots.acquire()
+        try:
+            self._executor.submit(self._process_request_worker, request, client_address)
+        except Exception:
+            self._worker_slots.release()
+            self.shutdown_request(request)
+            raise
+
+    def _process_request_worker(self, request, client_address):
+        self._count_active(1)
+        try:
+            try:
+                self.socket.handshake(request, client_address)
+            except (socket.error, BadALPNProtos) as error:
+                self.log_callback("TLS ALPN Challenge server: Handshake with {0} failed: {1}".format(client_address, error))
+                return
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._count_active(-1)
+            self._worker_slots.release()
+
+    def handle_error(self, request, client_address):
+        # socketserver prints a traceback to stderr by default
+        self.log_callback("TLS ALPN Challenge server: Error while handling request from {0}".format(client_address), traceback.format_exc())
+
+    def server_close(self):
+        super(TLSALPN01Server, self).server_close()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
     def _cert_selection(self, connection):
         # TODO: We would like to serve challenge cert only if asked for it via
         # ALPN. To do this, we need to retrieve the list of protos from client
@@ -171,26 +343,19 @@ class TLSALPN01Server(socketserver.TCPServer):
         # negotiation is done after cert selection.
         # Therefore, currently we always return challenge cert, and terminate
         # handshake in alpn_selection() if ALPN protos are not what we expect.
+        # The store holds a ready-made context for the challenge cert, which
+        # ALPNChallengeServer.add() created.
         # [0] https://github.com/openssl/openssl/issues/4952
         server_name = connection.get_servername()
         self.log_callback("TLS ALPN Challenge server: Serving challenge cert for server name {0}".format(server_name))
-        # return self.certs.get(server_name, None)
         if server_name.endswith(b'.'):
             server_name = server_name[:-1]
-        return self.challenge_certs.get(server_name)
-
-    def _alpn_selection(self, _connection, alpn_protos):
-        """Callback to select alpn protocol."""
-        if len(alpn_protos) == 1 and alpn_protos[0] == self.ACME_TLS_1_PROTOCOL:
-            self.log_callback("TLS ALPN Challenge server: Agreed on {0} ALPN".format(self.ACME_TLS_1_PROTOCOL))
-            return self.ACME_TLS_1_PROTOCOL
-        # Raising an exception causes openssl to terminate handshake and
-        # send fatal tls alert.
-        self.log_callback("TLS ALPN Challenge server: Cannot agree on ALPN proto. Got: {0}".format(alpn_protos))
-        raise BadALPNProtos("Got: {0}".format(alpn_protos))
+        return self.challenges.get(server_name, 'context')
 
     def _wrap_sock(self):
-        self.socket = SSLSocket(self.socket, self.log_callback, cert_selection=self._cert_selection, alpn_selection=self._alpn_selection)
+        self.socket = SSLSocket(
+            self.socket, self.log_callback, cert_selection=self._cert_selection, alpn_selection=self.alpn_selection,
+            handshake_on_accept=self._executor is None, handshake_timeout=self.handshake_timeout)
 
     def server_bind(self):
         self._wrap_sock()
@@ -198,53 +363,193 @@ class TLSALPN01Server(socketserver.TCPServer):
 
 
 class ALPNChallengeServer(object):
-    def __init__(self, port, log_callback):
-        self.certs = {}
-        self.challenge_certs = {}
+    def __init__(self, port, log_callback, ttl=None, handshake_workers=0, handshake_timeout=None):
+        self.challenges = ChallengeStore(default_ttl=ttl)
         self.server = None
         self.thread = None
         self.port = port
         self.log_callback = log_callback
-
-    def add(self, domain, key, cert_normal, cert_challenge):
-        if domain.endswith('.'):
-            domain = domain[:-1]
-        domain = domain.encode('utf-8')
-        self.certs[domain] = (key, cert_normal)
-        self.challenge_certs[domain] = (key, cert_challenge)
+        self.handshake_workers = handshake_workers
+        self.handshake_timeout = handshake_timeout
+        self.alpn_selection = ACMEALPNSelection(log_callback)
+        self._start_lock = threading.Lock()
+
+    def add(self, domain, key, cert_challenge, ttl=None):
+        self.add_many([(domain, key, cert_challenge)], ttl=ttl)
+
+    def add_many(self, challenges, ttl=None):
+        """Add several ``(domain, key, cert_challenge)`` challenges in one atomic update."""
+        entries = []
+        for domain, key, cert_challenge in challenges:
+            if domain.endswith('.'):
+                domain = domain[:-1]
+            domain = domain.encode('utf-8')
+            # Build the context once here instead of on every handshake
+            context = make_context(SSL.SSLv23_METHOD, key=key, cert=cert_challenge, alpn_selection=self.alpn_selection)
+            entries.append((domain, 'context', context))
+        self.challenges.update(entries, ttl=ttl)
 
     def remove(self, domain):
         if domain.endswith('.'):
             domain = domain[:-1]
         domain = domain.encode('utf-8')
-        self.certs.pop(domain)
-        self.challenge_certs.pop(domain)
+        self.challenges.remove_group(domain)
 
     def update(self):
-        if self.server is None and self.certs:
+        if len(self.challenges):
+            self.start()
+
+    def start(self):
+        """Launch the listener, if it is not running yet."""
+        with self._start_lock:
+            if self.server is not None:
+                return
             self.log_callback('Launching TLS ALPN challenge server...')
-            self.server = TLSALPN01Server(("", self.port), certs=self.certs, challenge_certs=self.challenge_certs, log_callback=self.log_callback)
+            self.server = TLSALPN01Server(
+                ("", self.port), challenges=self.challenges, log_callback=self.log_callback, alpn_selection=self.alpn_selection,
+                handshake_workers=self.handshake_workers, handshake_timeout=self.handshake_timeout)
             self.thread = threading.Thread(target=self.server.serve_forever)
             self.thread.daemon = True
             self.thread.start()
 
 
+class CertificateCache(object):
+    """Bounded LRU cache for generated challenge keys and certificates.
+
+    :ivar int size: Maximal number of entries; 0 disables caching.
+    :ivar float max_age: Seconds after which an entry counts as a miss, so
+        that no certificate close to its expiry is handed out.
+
+    """
+    def __init__(self, size, max_age=CERTIFICATE_LIFETIME.total_seconds() - 3600):
+        self.size = size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def get(self, cache_key):
+        """Return the cached value for ``cache_key``, or ``None``."""
+        if self.size <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or entry[1] + self.max_age <= time.monotonic():
+                if entry is not None:
+                    del self._entries[cache_key]
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            self._stats['hits'] += 1
+            return entry[0]
+
+    def put(self, cache_key, value):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[cache_key] = (value, time.monotonic())
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def get_or_create(self, cache_key, create):
+        """Return the cached value for ``cache_key``, or call ``create()`` and cache its result."""
+        value = self.get(cache_key)
+        if value is None:
+            value = create()
+            self.put(cache_key, value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result['entries'] = len(self._entries)
+        result['size'] = self.size
+        return result
+
+
+KEY_TYPES = ('rsa', 'ecdsa', 'ed25519')
+
+ACME_IDENTIFIER_OID = x509.ObjectIdentifier('1.3.6.1.5.5.7.1.31')
+
+
+def generate_key(key_type='rsa'):
+    """Generate a private key (RSA-2048, ECDSA P-256 or Ed25519) as `OpenSSL.crypto.PKey`."""
+    if key_type == 'rsa':
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, 2048)
+        return key
+    if key_type == 'ecdsa':
+        return crypto.PKey.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()))
+    if key_type == 'ed25519':
+        return crypto.PKey.from_cryptography_key(ed25519.Ed25519PrivateKey.generate())
+    raise ValueError('Unknown key type "{0}"; must be one of {1}'.format(key_type, ', '.join(KEY_TYPES)))
+
+
+def acme_identifier_extension(digest):
+    """Return the acmeIdentifier extension value (RFC 8737) for a SHA-256 digest."""
+    return x509.UnrecognizedExtension(ACME_IDENTIFIER_OID, b'\x04\x20' + digest)
+
+
+def parse_identifier(identifier):
+    """Split an ACME identifier like ``DNS:example.com`` or ``IP:::1`` into lists of domains and IPs."""
+    domains = []
+    ips = []
+    if identifier.upper().startswith('DNS:'):
+        domains.append(identifier[4:])
+    elif identifier.upper().startswith('IP:'):
+        ips.append(identifier[3:])
+    return domains, ips
+
+
+def create_challenge_cert(identifier, digest, key):
+    """Create the TLS-ALPN-01 challenge certificate for an identifier and key authorization digest."""
+    domains, ips = parse_identifier(identifier)
+    return gen_ss_cert(key, domains, ips, extensions=[acme_identifier_extension(digest)])
+
+
 def gen_ss_cert(key, domains, ips, extensions):
-    cert = crypto.X509()
-    cert.set_serial_number(int(binascii.hexlify(os.urandom(16)), 16))
-    cert.set_version(2)
-    extensions.append(crypto.X509Extension(b"basicConstraints", True, b"CA:TRUE, pathlen:0"))
-    cert.set_issuer(cert.get_subject())
-    sans = []
-    sans.extend([b"DNS:" + d.encode() for d in domains])
-    sans.extend([b"IP:" + d.encode() for d in ips])
-    extensions.append(crypto.X509Extension(b"subjectAltName", critical=False, value=b", ".join(sans)))
-    cert.add_extensions(extensions)
-    cert.gmtime_adj_notBefore(0)
-    cert.gmtime_adj_notAfter(24 * 60 * 60)
-    cert.set_pubkey(key)
-    cert.sign(key, "sha256")
-    return cert
-
-
-__all__ = ['ALPNChallengeServer', 'gen_ss_cert']
+    """Generate a self-signed certificate valid for `CERTIFICATE_LIFETIME`.
+
+    :param key: `OpenSSL.crypto.PKey` of any type returned by `generate_key`.
+    :param list extensions: Additional `cryptography.x509` extension values,
+        which are added as critical extensions.
+
+    """
+    private_key = key.to_cryptography_key()
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = x509.CertificateBuilder()
+    builder = builder.subject_name(x509.Name([]))
+    builder = builder.issuer_name(x509.Name([]))
+    builder = builder.serial_number(int(binascii.hexlify(os.urandom(16)), 16))
+    builder = builder.not_valid_before(now)
+    builder = builder.not_valid_after(now + CERTIFICATE_LIFETIME)
+    builder = builder.public_key(private_key.public_key())
+    for extension in extensions:
+        builder = builder.add_extension(extension, critical=True)
+    builder = builder.add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+    sans = [x509.DNSName(domain) for domain in domains]
+    sans.extend(x509.IPAddress(ipaddress.ip_address(ip)) for ip in ips)
+    builder = builder.add_extension(x509.SubjectAlternativeName(sans), critical=False)
+    # EdDSA keys sign without a separate digest
+    algorithm = None if isinstance(private_key, (ed25519.Ed25519PrivateKey, ed448.Ed448PrivateKey)) else hashes.SHA256()
+    return crypto.X509.from_cryptography(builder.sign(private_key, algorithm))
+
+
+__all__ = [
+    'ALPNChallengeServer',
+    'CertificateCache',
+    'KEY_TYPES',
+    'acme_identifier_extension',
+    'create_challenge_cert',
+    'gen_ss_cert',
+    'generate_key',
+    'parse_identifier',
+]
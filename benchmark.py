@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Load-generation benchmark for the controller.
+
+Starts the Pebble management stand-in from pebble_standin.py and the
+controller in this process, on free local ports, and drives the HTTP, DNS
+(UDP and TCP), TLS-ALPN and OCSP paths at a configurable concurrency. For
+every scenario, throughput and p50/p99 latencies are reported. TLS-ALPN
+scenarios run once per key type given with --key-types; every tls-alpn-batch
+request registers 50 challenges, and that scenario only sends --batch-requests
+requests.
+
+Example:
+
+    python benchmark.py --scenarios dns-udp,ocsp --requests 5000 --concurrency 32
+    python benchmark.py --scenarios tls-alpn-put,tls-alpn --key-types rsa,ecdsa,ed25519
+
+Load generator and servers share one interpreter, so absolute numbers are
+pessimistic; compare runs on the same machine to spot regressions.
+'''
+
+import argparse
+import base64
+import concurrent.futures
+import hashlib
+import http.client
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+
+SCENARIOS = ['http-put', 'http-get', 'dns-udp', 'dns-tcp', 'tls-alpn-put', 'tls-alpn-batch', 'tls-alpn', 'ocsp']
+
+KEY_TYPE_SCENARIOS = ('tls-alpn-put', 'tls-alpn-batch', 'tls-alpn')
+
+TLS_ALPN_BATCH_SIZE = 50
+
+
+def _find_free_port():
+    '''
+    Finds a port which is free for both TCP and UDP on localhost.
+    '''
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_sock:
+            tcp_sock.bind(('127.0.0.1', 0))
+            port = tcp_sock.getsockname()[1]
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+                try:
+                    udp_sock.bind(('127.0.0.1', port))
+                except OSError:
+                    continue
+        return port
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+class Environment(object):
+    '''
+    Pebble stand-in plus in-process controller listening on local ports.
+    '''
+
+    def __init__(self, roots=1, log_level='WARNING'):
+        from pebble_standin import PebbleStandIn
+
+        self.standin = PebbleStandIn(host='localhost', port=0, roots=roots)
+        self.standin.start()
+        self.dns_port = _find_free_port()
+        self.tls_alpn_port = _find_free_port()
+        os.environ.update({
+            'PEBBLE_MANAGEMENT_PORT': str(self.standin.port),
+            'PEBBLE_ALTERNATE_ROOTS': str(roots - 1),
+            'DNS_PORT': str(self.dns_port),
+            'TLS_ALPN_PORT': str(self.tls_alpn_port),
+            'LOG_LEVEL': log_level,
+        })
+
+        # The controller configures itself from the environment on import
+        import controller
+        from werkzeug.serving import make_server
+
+        self.controller = controller
+        self.server = make_server('localhost', 0, controller.app, threaded=True)
+        self.controller_port = self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self._local = threading.local()
+        self.wait_until_ready()
+
+    def wait_until_ready(self, timeout=120):
+        '''
+        Waits for the controller's warm-up, so that it does not count towards the first scenario.
+        '''
+        deadline = time.monotonic() + timeout
+        while True:
+            status, data = self.call('GET', '/ready')
+            if status == 200:
+                return
+            if time.monotonic() >= deadline:
+                raise Exception('Controller did not become ready within {0} seconds: {1}'.format(timeout, data))
+            time.sleep(0.1)
+
+    def call(self, method, path, body=None, headers=None):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = http.client.HTTPConnection('localhost', self.controller_port, timeout=30)
+            self._local.connection = connection
+        try:
+            connection.request(method, path, body=body, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, response.read()
+        except Exception:
+            connection.close()
+            self._local.connection = None
+            raise
+
+    def check_call(self, method, path, body=None, headers=None):
+        status, data = self.call(method, path, body=body, headers=headers)
+        if status != 200:
+            raise Exception('{0} {1} returned {2}: {3}'.format(method, path, status, data))
+        return data
+
+
+def _setup_http_put(env, requests):
+    def operation(index):
+        env.check_call('PUT', '/http/put-{0}.example/token-{1}'.format(index % 100, index), body=b'key-authorization')
+
+    return operation
+
+
+def _setup_http_get(env, requests):
+    count = min(requests, 1000)
+    entries = [
+        {'host': 'get-{0}.example'.format(index % 100), 'filename': 'token-{0}'.format(index), 'value': 'key-authorization'}
+        for index in range(count)
+    ]
+    env.check_call('PUT', '/http', body=json.dumps(entries))
+
+    def operation(index):
+        entry = entries[index % count]
+        env.check_call('GET', '/.well-known/acme-challenge/{0}'.format(entry['filename']), headers={'Host': entry['host']})
+
+    return operation
+
+
+def _setup_dns(env, requests, tcp):
+    from dnslib import DNSRecord
+
+    count = min(requests, 1000)
+    names = ['_acme-challenge.dns-{0}.example'.format(index) for index in range(count)]
+    for name in names:
+        env.check_call('PUT', '/dns/{0}'.format(name), body=json.dumps(['value-1', 'value-2']))
+    queries = [DNSRecord.question(name, 'TXT') for name in names]
+
+    def operation(index):
+        reply = DNSRecord.parse(queries[index % count].send('127.0.0.1', env.dns_port, tcp=tcp, timeout=10))
+        if len(reply.rr) != 2:
+            raise Exception('Expected 2 TXT records, got {0}'.format(len(reply.rr)))
+
+    return operation
+
+
+def _setup_tls_alpn_put(env, requests, key_type):
+    def operation(index):
+        # Unique domains, so that the controller's certificate cache does not answer
+        domain = 'alpn-put-{0}-{1}.example'.format(key_type, index)
+        der_value = base64.standard_b64encode(hashlib.sha256(domain.encode('utf-8')).digest())
+        env.check_call('PUT', '/tls-alpn/{0}/DNS:{0}/der-value-b64?key-type={1}'.format(domain, key_type), body=der_value)
+
+    return operation
+
+
+def _setup_tls_alpn_batch(env, requests, key_type):
+    def operation(index):
+        entries = []
+        for offset in range(TLS_ALPN_BATCH_SIZE):
+            domain = 'alpn-batch-{0}-{1}-{2}.example'.format(key_type, index, offset)
+            entries.append({
+                'domain': domain,
+                'identifier': 'DNS:{0}'.format(domain),
+                'der-value-b64': base64.standard_b64encode(hashlib.sha256(domain.encode('utf-8')).digest()).decode('ascii'),
+                'key-type': key_type,
+            })
+        env.check_call('PUT', '/tls-alpn', body=json.dumps(entries))
+
+    return operation
+
+
+def _setup_tls_alpn(env, requests, key_type):
+    from OpenSSL import SSL
+
+    count = min(requests, 20)
+    domains = ['alpn-{0}-{1}.example'.format(key_type, index) for index in range(count)]
+    for domain in domains:
+        der_value = base64.standard_b64encode(hashlib.sha256(domain.encode('utf-8')).digest())
+        env.check_call('PUT', '/tls-alpn/{0}/DNS:{0}/der-value-b64?key-type={1}'.format(domain, key_type), body=der_value)
+    context = SSL.Context(SSL.SSLv23_METHOD)
+    context.set_alpn_protos([b'acme-tls/1'])
+
+    def operation(index):
+        sock = socket.create_connection(('127.0.0.1', env.tls_alpn_port), timeout=10)
+        # pyOpenSSL needs a blocking socket, otherwise do_handshake() raises WantReadError
+        sock.settimeout(None)
+        try:
+            connection = SSL.Connection(context, sock)
+            connection.set_tlsext_host_name(domains[index % count].encode('utf-8'))
+            connection.set_connect_state()
+            connection.do_handshake()
+            if connection.get_alpn_proto_negotiated() != b'acme-tls/1':
+                raise Exception('ALPN negotiation failed')
+        finally:
+            sock.close()
+
+    return operation
+
+
+def _setup_ocsp(env, requests):
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.x509 import ocsp
+
+    count = min(requests, 50)
+    ocsp_requests = []
+    for index in range(count):
+        root = index % len(env.standin.roots)
+        certificate = env.standin.issue_certificate('ocsp-{0}.example'.format(index), root=root)
+        builder = ocsp.OCSPRequestBuilder().add_certificate(certificate, env.standin.intermediates[root], hashes.SHA1())
+        ocsp_requests.append(builder.build().public_bytes(serialization.Encoding.DER))
+
+    def operation(index):
+        data = env.check_call('POST', '/ocsp', body=ocsp_requests[index % count], headers={'Content-Type': 'application/ocsp-request'})
+        response = ocsp.load_der_ocsp_response(data)
+        if response.response_status != ocsp.OCSPResponseStatus.SUCCESSFUL:
+            raise Exception('OCSP response status {0}'.format(response.response_status))
+
+    return operation
+
+
+SETUP = {
+    'http-put': _setup_http_put,
+    'http-get': _setup_http_get,
+    'dns-udp': lambda env, requests: _setup_dns(env, requests, tcp=False),
+    'dns-tcp': lambda env, requests: _setup_dns(env, requests, tcp=True),
+    'tls-alpn-put': _setup_tls_alpn_put,
+    'tls-alpn-batch': _setup_tls_alpn_batch,
+    'tls-alpn': _setup_tls_alpn,
+    'ocsp': _setup_ocsp,
+}
+
+
+def run_scenario(name, operation, requests, concurrency, warmup=10):
+    for index in range(min(warmup, requests)):
+        operation(index)
+
+    latencies = [None] * requests
+    errors = []
+
+    def run_one(index):
+        start = time.perf_counter()
+        try:
+            operation(index)
+        except Exception as e:
+            errors.append(e)
+            return
+        latencies[index] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run_one, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    values = sorted(latency for latency in latencies if latency is not None)
+    return {
+        'scenario': name,
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'first_error': str(errors[0]) if errors else None,
+        'seconds': elapsed,
+        'throughput': len(values) / elapsed if elapsed > 0 else None,
+        'p50_ms': _percentile(values, 0.5) * 1000 if values else None,
+        'p99_ms': _percentile(values, 0.99) * 1000 if values else None,
+    }
+
+
+def _format_number(value, pattern):
+    return pattern.format(value) if value is not None else '-'
+
+
+def print_results(results):
+    print('{0:<22} {1:>9} {2:>6} {3:>7} {4:>12} {5:>10} {6:>10}'.format(
+        'scenario', 'requests', 'conc', 'errors', 'req/s', 'p50 ms', 'p99 ms'))
+    for result in results:
+        print('{0:<22} {1:>9} {2:>6} {3:>7} {4:>12} {5:>10} {6:>10}'.format(
+            result['scenario'],
+            result['requests'],
+            result['concurrency'],
+            result['errors'],
+            _format_number(result['throughput'], '{0:.1f}'),
+            _format_number(result['p50_ms'], '{0:.2f}'),
+            _format_number(result['p99_ms'], '{0:.2f}')))
+        if result['first_error']:
+            print('  first error: {0}'.format(result['first_error']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ACME test container controller')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='comma-separated list out of {0}'.format(', '.join(SCENARIOS)))
+    parser.add_argument('--requests', type=int, default=1000, help='requests per scenario')
+    parser.add_argument('--batch-requests', type=int, default=10,
+                        help='requests for tls-alpn-batch, which registers {0} challenges per request'.format(TLS_ALPN_BATCH_SIZE))
+    parser.add_argument('--concurrency', type=int, default=8, help='number of concurrent clients')
+    parser.add_argument('--warmup', type=int, default=10, help='untimed requests before every scenario')
+    parser.add_argument('--roots', type=int, default=1, help='number of CA roots in the Pebble stand-in')
+    parser.add_argument('--key-types', default='rsa', help='comma-separated TLS-ALPN key types out of rsa, ecdsa, ed25519')
+    parser.add_argument('--log-level', default='WARNING', help='controller log level')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = [scenario for scenario in scenarios if scenario not in SETUP]
+    if unknown:
+        parser.error('Unknown scenarios: {0}'.format(', '.join(unknown)))
+
+    key_types = [key_type.strip() for key_type in args.key_types.split(',') if key_type.strip()]
+
+    env = Environment(roots=args.roots, log_level=args.log_level)
+    results = []
+    for scenario in scenarios:
+        if scenario in KEY_TYPE_SCENARIOS:
+            requests = args.batch_requests if scenario == 'tls-alpn-batch' else args.requests
+            warmup = min(args.warmup, 1) if scenario == 'tls-alpn-batch' else args.warmup
+            for key_type in key_types:
+                operation = SETUP[scenario](env, requests, key_type)
+                name = '{0}[{1}]'.format(scenario, key_type)
+                results.append(run_scenario(name, operation, requests, args.concurrency, warmup=warmup))
+            continue
+        operation = SETUP[scenario](env, args.requests)
+        results.append(run_scenario(scenario, operation, args.requests, args.concurrency, warmup=args.warmup))
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_results(results)
+    return 1 if any(result['errors'] for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+
+class ChallengeStore(object):
+    '''
+    Thread-safe two-level mapping ``group -> name -> value`` with optional
+    per-entry expiry.
+
+    Groups without live entries are dropped as soon as their last entry is
+    removed, and expired entries are invisible to readers and removed by
+    ``sweep()``, so that memory stays bounded in long-lived containers.
+    '''
+
+    def __init__(self, default_ttl=None):
+        self.default_ttl = default_ttl
+        self._lock = threading.RLock()
+        self._groups = {}
+
+    def _get_expiry(self, ttl):
+        if ttl is None:
+            ttl = self.default_ttl
+        if not ttl:
+            return None
+        return time.monotonic() + ttl
+
+    @staticmethod
+    def _is_alive(entry, now):
+        return entry[1] is None or entry[1] > now
+
+    def get(self, group, name, default=None):
+        with self._lock:
+            entry = self._groups.get(group, {}).get(name)
+        if entry is None or not self._is_alive(entry, time.monotonic()):
+            return default
+        return entry[0]
+
+    def get_group(self, group):
+        '''
+        Returns a copy of all live entries of a group as a dictionary, or ``None``
+        if the group has no live entries.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            entries = self._groups.get(group)
+            if entries is None:
+                return None
+            result = dict((name, entry[0]) for name, entry in entries.items() if self._is_alive(entry, now))
+        return result or None
+
+    def __contains__(self, group):
+        return self.get_group(group) is not None
+
+    def set(self, group, name, value, ttl=None):
+        self.update([(group, name, value)], ttl=ttl)
+
+    def update(self, entries, ttl=None):
+        '''
+        Sets all ``(group, name, value)`` triples in ``entries`` in one step.
+        '''
+        expiry = self._get_expiry(ttl)
+        with self._lock:
+            for group, name, value in entries:
+                if group not in self._groups:
+                    self._groups[group] = {}
+                self._groups[group][name] = (value, expiry)
+
+    def modify_many(self, entries, ttl=None):
+        '''
+        Atomically replaces the values of several entries. ``entries`` is a list
+        of ``(group, name, function)`` triples; ``function`` is called with the
+        current value (``None`` if there is none) while the store is locked and
+        returns the new value, or ``None`` to remove the entry.
+        '''
+        expiry = self._get_expiry(ttl)
+        now = time.monotonic()
+        with self._lock:
+            for group, name, function in entries:
+                entry = self._groups.get(group, {}).get(name)
+                value = entry[0] if entry is not None and self._is_alive(entry, now) else None
+                value = function(value)
+                if value is None:
+                    self._remove_entry(group, name)
+                else:
+                    if group not in self._groups:
+                        self._groups[group] = {}
+                    self._groups[group][name] = (value, expiry)
+
+    def remove(self, group, name):
+        '''
+        Removes an entry. Returns ``False`` if it does not exist.
+        '''
+        return not self.remove_many([(group, name)])
+
+    def remove_many(self, entries):
+        '''
+        Removes all ``(group, name)`` pairs in ``entries`` in one step. If some of
+        them do not exist, nothing is removed and the list of missing pairs is
+        returned.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            missing = []
+            for group, name in entries:
+                entry = self._groups.get(group, {}).get(name)
+                if entry is None or not self._is_alive(entry, now):
+                    missing.append((group, name))
+            if missing:
+                return missing
+            for group, name in entries:
+                self._remove_entry(group, name)
+        return []
+
+    def _remove_entry(self, group, name):
+        entries = self._groups.get(group)
+        if entries is None:
+            return
+        entries.pop(name, None)
+        if not entries:
+            del self._groups[group]
+
+    def remove_group(self, group):
+        '''
+        Removes a group with all its entries. Returns ``False`` if it does not exist.
+        '''
+        with self._lock:
+            return self._groups.pop(group, None) is not None
+
+    def sweep(self):
+        '''
+        Removes all expired entries and empty groups. Returns the number of
+        removed entries.
+        '''
+        now = time.monotonic()
+        removed = 0
+        with self._lock:
+            for group in list(self._groups):
+                entries = self._groups[group]
+                expired = [name for name, entry in entries.items() if not self._is_alive(entry, now)]
+                for name in expired:
+                    del entries[name]
+                removed += len(expired)
+                if not entries:
+                    del self._groups[group]
+        return removed
+
+    def group_count(self):
+        with self._lock:
+            return len(self._groups)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._groups.values())
+
+
+def start_sweeper(stores, interval, log_callback=None):
+    '''
+    Starts a daemon thread which calls ``sweep()`` on all stores every
+    ``interval`` seconds.
+    '''
+    def sweep_forever():
+        while True:
+            time.sleep(interval)
+            for name, store in stores.items():
+                removed = store.sweep()
+                if removed and log_callback is not None:
+                    log_callback('Evicted {0} expired entries from {1}'.format(removed, name))
+
+    thread = threading.Thread(target=sweep_forever)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+__all__ = ['ChallengeStore', 'start_sweeper']
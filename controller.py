@@ -19,24 +19,32 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
 import base64
-import codecs
+import concurrent.futures
+import datetime
+import json
 import logging
 import os
 import re
-import ssl
-import sys
-import urllib
+import time
 
 from functools import partial
 
-from flask import Flask, request
+from flask import Flask, Response, g, jsonify, make_response, request
 
-from acme_tlsalpn import ALPNChallengeServer, gen_ss_cert
+from acme_tlsalpn import KEY_TYPES, ALPNChallengeServer, CertificateCache, create_challenge_cert, generate_key
+
+from challenge_store import ChallengeStore, start_sweeper
 
 from OpenSSL import crypto
 
+from crl import CRLStore
 from dns_server import DNSServer
-from ocsp import get_ocsp_response
+from key_pool import KeyPool
+from log_writer import LogWriter, parse_level
+from metrics import REGISTRY
+from ocsp import IssuerIndex, OCSPResponseCache, OCSPWorkerPool, get_certificate_status, get_ocsp_response
+from pebble_management import FileCache, PebbleClient, PebbleDocumentCache
+from warmup import Warmup, wait_until
 
 
 app = Flask(__name__)
@@ -45,27 +53,30 @@ app.config['LOGGER_HANDLER_POLICY'] = 'always'
 PEBBLE_PATH = os.path.join(os.path.abspath(os.environ.get('GOPATH', '.')), 'src', 'github.com', 'letsencrypt', 'pebble')
 
 
-challenges = {}
+# Default lifetime of challenges in seconds; 0 means they never expire
+CHALLENGE_TTL = float(os.environ.get('CHALLENGE_TTL') or '0') or None
+CHALLENGE_SWEEP_INTERVAL = float(os.environ.get('CHALLENGE_SWEEP_INTERVAL') or '60')
+
+challenges = ChallengeStore(default_ttl=CHALLENGE_TTL)
+
 
+log_writer = LogWriter(
+    level=parse_level(os.environ.get('LOG_LEVEL')),
+    batch_size=int(os.environ.get('LOG_BATCH_SIZE') or '256'),
+    buffer_size=int(os.environ.get('LOG_BUFFER_SIZE') or '1000'))
+log_writer.start()
 
-def log(message, data=None, program='Controller'):
-    sys.stdout.write('[{0}] {1}\n'.format(program, message))
-    if data:
-        if not isinstance(data, list):
-            data = [data]
-        while data and not data[-1]:
-            data = data[:-1]
-        for value in data:
-            sys.stdout.write('[{0}] | {1}\n'.format(program, value))
-    sys.stdout.flush()
+
+def log(message, data=None, program='Controller', level=logging.INFO, args=()):
+    log_writer.log(message, data=data, program=program, level=level, args=args)
 
 
 def setup_loggers():
     class SimpleLogger(logging.StreamHandler):
         def emit(self, record):
             try:
-                msg = self.format(record)
-                log(msg)
+                if log_writer.is_enabled_for(record.levelno):
+                    log(partial(self.format, record), level=record.levelno)
             except (KeyboardInterrupt, SystemExit):
                 raise
             except Exception as _:
@@ -86,61 +97,308 @@ def setup_loggers():
 setup_loggers()
 
 
+ROUTE_REQUESTS = REGISTRY.counter('acme_controller_requests_total', 'Controller requests', ('route', 'method', 'status'))
+ROUTE_SECONDS = REGISTRY.histogram('acme_controller_request_seconds', 'Controller request latency', ('route', 'method'))
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.monotonic()
+
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+    ROUTE_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    ROUTE_SECONDS.observe(time.monotonic() - g.get('request_start', time.monotonic()), route=route, method=request.method)
+    return response
+
+
 @app.route('/')
 def m_index():
     return 'ACME test environment controller'
 
 
+@app.route('/metrics')
+def get_metrics():
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/logs')
+def get_logs():
+    try:
+        level = parse_level(request.args.get('level'))
+    except ValueError as e:
+        return str(e), 400
+    records = log_writer.get_recent(
+        limit=request.args.get('limit', default=None, type=int),
+        level=level,
+        program=request.args.get('program'))
+    return jsonify(records)
+
+
+def _get_ttl():
+    return request.args.get('ttl', default=None, type=float)
+
+
 @app.route('/http/<string:host>/<string:filename>', methods=['PUT', 'DELETE'])
 def http_challenge(host, filename):
     if request.method == 'PUT':
-        if host not in challenges:
-            challenges[host] = {}
         value = request.data
-        log('Defining challenge file for {0}'.format(host), '/.well-known/acme-challenge/{0} => {1}'.format(filename, value))
-        challenges[host][filename] = value
+        log('Defining challenge file for {0}', partial('/.well-known/acme-challenge/{0} => {1}'.format, filename, value), args=(host, ))
+        challenges.set(host, filename, value, ttl=_get_ttl())
         return 'ok'
     else:
-        if host not in challenges or filename not in challenges[host]:
+        if not challenges.remove(host, filename):
             return 'not found', 404
-        log('Removing challenge file for {0}'.format(host), '/.well-known/acme-challenge/{0}'.format(filename))
-        del challenges[host][filename]
+        log('Removing challenge file for {0}', partial('/.well-known/acme-challenge/{0}'.format, filename), args=(host, ))
         return 'ok'
 
 
-dns_server = DNSServer(port=53, log_callback=partial(log, program='DNS Server'))
+def _parse_batch(data):
+    '''
+    Parses a batch request body. Accepts either a JSON list of objects, or
+    newline-delimited JSON (one object per line).
+    '''
+    text = data.decode('utf-8')
+    if text.lstrip().startswith('['):
+        entries = json.loads(text)
+    else:
+        entries = [json.loads(line) for line in text.splitlines() if line.strip()]
+    if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+        raise ValueError('Batch must be a list of objects')
+    return entries
+
+
+@app.route('/http', methods=['PUT', 'DELETE'])
+def http_challenge_batch():
+    try:
+        entries = _parse_batch(request.data)
+        if request.method == 'PUT':
+            entries = [(str(entry['host']), str(entry['filename']), str(entry['value']).encode('utf-8')) for entry in entries]
+        else:
+            entries = [(str(entry['host']), str(entry['filename'])) for entry in entries]
+    except (ValueError, KeyError) as e:
+        log('Invalid HTTP challenge batch: {0}'.format(e))
+        return 'invalid batch', 400
+    if request.method == 'PUT':
+        challenges.update(entries, ttl=_get_ttl())
+        log('Defined {0} challenge files for {1} hosts', args=(len(entries), len(set(entry[0] for entry in entries))))
+    else:
+        # Only removes something if all challenge files exist, so that the batch is applied atomically
+        missing = challenges.remove_many(entries)
+        if missing:
+            return 'not found: {0} /.well-known/acme-challenge/{1}'.format(*missing[0]), 404
+        log('Removed {0} challenge files for {1} hosts', args=(len(entries), len(set(entry[0] for entry in entries))))
+    return 'ok'
+
+
+dns_server = DNSServer(
+    port=int(os.environ.get('DNS_PORT') or '53'),
+    log_callback=partial(log, program='DNS Server'),
+    ttl=CHALLENGE_TTL,
+    engine=os.environ.get('DNS_SERVER_ENGINE') or 'threaded',
+    log_mode=os.environ.get('DNS_LOG_MODE') or 'full',
+    log_sample_rate=int(os.environ.get('DNS_LOG_SAMPLE_RATE') or '100'),
+    workers=int(os.environ.get('DNS_WORKERS') or '0'),
+    sweep_interval=CHALLENGE_SWEEP_INTERVAL)
 
 
-@app.route('/dns/<string:record>', methods=['PUT', 'DELETE'])
+@app.route('/dns/<string:record>', methods=['PUT', 'PATCH', 'DELETE'])
 def dns_challenge(record):
     if request.method == 'PUT':
         values = request.get_json(force=True)
-        log('Adding TXT records for {0}'.format(record), values)
-        dns_server.set_txt_records(record, values)
+        log('Adding TXT records for {0}', values, args=(record, ))
+        dns_server.set_txt_records(record, values, ttl=_get_ttl())
+    elif request.method == 'PATCH':
+        data = request.get_json(force=True)
+        try:
+            change = _parse_txt_change(record, data)
+        except ValueError as e:
+            return str(e), 400
+        log('Changing TXT records for {0}', partial(json.dumps, data, sort_keys=True), args=(record, ))
+        dns_server.update_txt_records([change], ttl=_get_ttl())
     else:
-        log('Removing TXT records for {0}'.format(record))
+        log('Removing TXT records for {0}', args=(record, ))
         dns_server.clear_txt_records(record)
     return 'ok'
 
 
-tls_alpn_server = ALPNChallengeServer(port=5001, log_callback=log)
+def _parse_txt_values(data, key):
+    values = data.get(key, [])
+    if not isinstance(values, list) or not all(isinstance(value, str) for value in values):
+        raise ValueError('"{0}" must be a list of strings'.format(key))
+    return values
+
+
+def _parse_txt_change(record, data):
+    '''
+    Converts ``{"set": [...], "add": [...], "remove": [...]}`` (all optional)
+    into a change for ``DNSServer.update_txt_records()``.
+    '''
+    if not isinstance(data, dict) or not set(data).issubset(('set', 'add', 'remove')):
+        raise ValueError('Change for {0} must be an object with keys "set", "add" and/or "remove"'.format(record))
+    set_values = _parse_txt_values(data, 'set') if 'set' in data else None
+    return record, set_values, _parse_txt_values(data, 'add'), _parse_txt_values(data, 'remove')
+
+
+@app.route('/dns', methods=['PATCH'])
+def dns_challenge_batch():
+    data = request.get_json(force=True)
+    try:
+        if not isinstance(data, dict):
+            raise ValueError('Batch must be an object mapping records to changes')
+        changes = [_parse_txt_change(record, change) for record, change in data.items()]
+    except ValueError as e:
+        return str(e), 400
+    dns_server.update_txt_records(changes, ttl=_get_ttl())
+    log('Changed TXT records for {0} names', args=(len(changes), ))
+    return 'ok'
+
+
+@app.route('/dns-query-counts', methods=['GET', 'DELETE'])
+def dns_query_counts():
+    if dns_server.workers:
+        # Queries are counted in the worker processes, which do not report back
+        return 'query counts are not available with DNS_WORKERS', 501
+    if request.method == 'DELETE':
+        dns_server.logger.reset_query_counts()
+        return 'ok'
+    counts = dns_server.logger.get_query_counts(limit=request.args.get('limit', default=None, type=int))
+    return jsonify([{'name': name, 'qtype': qtype, 'count': count} for name, qtype, count in counts])
+
+
+@app.route('/dns-zone/<string:name>', methods=['PUT', 'DELETE'])
+def dns_zone_entry(name):
+    if request.method == 'PUT':
+        data = request.get_json(force=True)
+        try:
+            dns_server.update_zone([(name, data)])
+        except ValueError as e:
+            return str(e), 400
+        log('Setting DNS records for {0}', partial(json.dumps, data, sort_keys=True), args=(name, ))
+    else:
+        if not dns_server.remove_zone(name):
+            return 'not found', 404
+        log('Removing DNS records for {0}', args=(name, ))
+    return 'ok'
+
+
+@app.route('/dns-zone', methods=['PUT'])
+def dns_zone_batch():
+    try:
+        entries = request.get_json(force=True)
+        if not isinstance(entries, dict):
+            raise ValueError('Batch must be an object mapping names to records')
+        entries = list(entries.items())
+        dns_server.update_zone(entries)
+    except ValueError as e:
+        return str(e), 400
+    log('Set DNS records for {0} names', args=(len(entries), ))
+    return 'ok'
+
+
+# Number of threads running TLS-ALPN handshakes concurrently; 0 runs them in the accept loop
+TLS_ALPN_HANDSHAKE_WORKERS = int(os.environ.get('TLS_ALPN_HANDSHAKE_WORKERS') or '16')
+# Seconds a TLS-ALPN handshake may take; 0 disables the timeout
+TLS_ALPN_HANDSHAKE_TIMEOUT = float(os.environ.get('TLS_ALPN_HANDSHAKE_TIMEOUT') or '10') or None
+
+tls_alpn_server = ALPNChallengeServer(
+    port=int(os.environ.get('TLS_ALPN_PORT') or '5001'), log_callback=log, ttl=CHALLENGE_TTL,
+    handshake_workers=TLS_ALPN_HANDSHAKE_WORKERS, handshake_timeout=TLS_ALPN_HANDSHAKE_TIMEOUT)
+
+start_sweeper({
+    'HTTP challenges': challenges,
+    'DNS TXT records': dns_server.txt_records,
+    'TLS ALPN challenges': tls_alpn_server.challenges,
+}, CHALLENGE_SWEEP_INTERVAL, log_callback=log)
+
+
+def _get_challenge_store_sizes(count):
+    return [
+        (('http', ), count(challenges)),
+        (('dns', ), count(dns_server.txt_records)),
+        (('tls-alpn', ), count(tls_alpn_server.challenges)),
+    ]
+
+
+REGISTRY.gauge('acme_challenge_store_entries', 'Number of entries in the challenge stores', ('store', ),
+               callback=partial(_get_challenge_store_sizes, len))
+REGISTRY.gauge('acme_challenge_store_groups', 'Number of hosts, DNS names or domains in the challenge stores', ('store', ),
+               callback=partial(_get_challenge_store_sizes, lambda store: store.group_count()))
+REGISTRY.gauge('acme_dns_zone_names', 'Number of names with A, AAAA or CNAME overrides',
+               callback=lambda: [((), len(dns_server.zone))])
 
 
-def _get_alpn_key_cert_from_der_value(domain, identifier, data):
-    der_value = b"DER:0420" + codecs.encode(base64.standard_b64decode(data), 'hex')
-    domains = []
-    ips = []
-    if identifier.upper().startswith('DNS:'):
-        domains.append(identifier[4:])
-    elif identifier.upper().startswith('IP:'):
-        ips.append(identifier[3:])
-    # Create private key
-    key = crypto.PKey()
-    key.generate_key(crypto.TYPE_RSA, 2048)
+TLS_ALPN_KEY_TYPE = os.environ.get('TLS_ALPN_KEY_TYPE') or 'rsa'
+if TLS_ALPN_KEY_TYPE not in KEY_TYPES:
+    raise ValueError('TLS_ALPN_KEY_TYPE must be one of {0}'.format(', '.join(KEY_TYPES)))
+
+alpn_key_pools = {}
+for key_type in KEY_TYPES:
+    alpn_key_pools[key_type] = KeyPool(
+        partial(generate_key, key_type), size=int(os.environ.get('TLS_ALPN_KEY_POOL_SIZE') or '8'),
+        name='TLS ALPN {0}'.format(key_type), log_callback=log)
+# Pools for other key types only start filling once they are used
+alpn_key_pools[TLS_ALPN_KEY_TYPE].start()
+REGISTRY.gauge('acme_tls_alpn_key_pool', 'TLS-ALPN challenge key pool statistics', ('key_type', 'stat'),
+               callback=lambda: [((key_type, name), value) for key_type, pool in sorted(alpn_key_pools.items()) for name, value in sorted(pool.get_stats().items())])
+
+
+alpn_cert_cache = CertificateCache(size=int(os.environ.get('TLS_ALPN_CERT_CACHE_SIZE') or '256'))
+REGISTRY.gauge('acme_tls_alpn_cert_cache', 'TLS-ALPN challenge certificate cache statistics', ('stat', ),
+               callback=lambda: [((name, ), value) for name, value in sorted(alpn_cert_cache.get_stats().items())])
+
+
+def _get_key_type():
+    key_type = request.args.get('key-type', default=TLS_ALPN_KEY_TYPE)
+    if key_type not in KEY_TYPES:
+        raise ValueError('key-type must be one of {0}'.format(', '.join(KEY_TYPES)))
+    return key_type
+
+
+def _create_alpn_key_cert_from_der_value(identifier, digest, key_type):
+    # Take private key from the pool
+    alpn_key_pools[key_type].start()
+    key = alpn_key_pools[key_type].get()
     # Create self-signed certificates
-    acme_extension = crypto.X509Extension(b"1.3.6.1.5.5.7.1.31", critical=True, value=der_value)
-    cert_challenge = gen_ss_cert(key, domains, ips, extensions=[acme_extension])
-    return key, cert_challenge
+    return key, create_challenge_cert(identifier, digest, key)
+
+
+def _get_alpn_key_cert_from_der_value(domain, identifier, digest, key_type):
+    # Retries and re-PUTs of the same challenge reuse the certificate
+    return alpn_cert_cache.get_or_create(
+        (domain, identifier, digest, key_type),
+        partial(_create_alpn_key_cert_from_der_value, identifier, digest, key_type))
+
+
+# Number of threads generating keys and certificates for batch requests; 0 generates them on the request thread
+TLS_ALPN_BATCH_THREADS = int(os.environ.get('TLS_ALPN_BATCH_THREADS') or str(os.cpu_count() or 1))
+# Seconds a batch request may spend generating keys and certificates
+TLS_ALPN_BATCH_TIMEOUT = float(os.environ.get('TLS_ALPN_BATCH_TIMEOUT') or '120')
+
+# Key generation and signing release the GIL in OpenSSL, so threads run them in parallel
+alpn_batch_executor = None
+if TLS_ALPN_BATCH_THREADS > 0:
+    alpn_batch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=TLS_ALPN_BATCH_THREADS)
+
+
+def _get_alpn_key_certs_from_der_values(entries):
+    '''
+    Returns ``(key, cert_challenge)`` for every ``(domain, identifier, digest, key_type)``
+    entry. Entries which are not cached are generated in parallel on ``alpn_batch_executor``.
+    Raises ``concurrent.futures.TimeoutError`` after ``TLS_ALPN_BATCH_TIMEOUT`` seconds.
+    '''
+    if alpn_batch_executor is None or len(entries) <= 1:
+        return [_get_alpn_key_cert_from_der_value(*entry) for entry in entries]
+    futures = [alpn_batch_executor.submit(_get_alpn_key_cert_from_der_value, *entry) for entry in entries]
+    done, not_done = concurrent.futures.wait(futures, timeout=TLS_ALPN_BATCH_TIMEOUT)
+    if not_done:
+        # Entries which have not been started yet are dropped; running ones still end up in the cache
+        for future in not_done:
+            future.cancel()
+        raise concurrent.futures.TimeoutError()
+    return [future.result() for future in futures]
 
 
 def _find_line_regex(lines, regex):
@@ -164,29 +422,58 @@ def _get_alpn_key_cert_from_pem_chain(domain, identifier, data):
 
 @app.route('/tls-alpn/<string:domain>/<string:identifier>/der-value-b64', methods=['PUT'])
 def tls_alpn_challenge_put_b64(domain, identifier):
-    log('Adding TLS ALPN challenge for domain {0} and identifier {1} (Base64 encoded DER value)'.format(domain, identifier))
-    key, cert_challenge = _get_alpn_key_cert_from_der_value(domain, identifier, request.data)
-    cert_normal = gen_ss_cert(key, [domain], [], [])
+    log('Adding TLS ALPN challenge for domain {0} and identifier {1} (Base64 encoded DER value)', args=(domain, identifier))
+    try:
+        key_type = _get_key_type()
+    except ValueError as e:
+        return str(e), 400
+    digest = base64.standard_b64decode(request.data)
+    key, cert_challenge = _get_alpn_key_cert_from_der_value(domain, identifier, digest, key_type)
     # Start/modify TLS-ALPN-01 challenge server
-    tls_alpn_server.add(domain, key, cert_normal, cert_challenge)
+    tls_alpn_server.add(domain, key, cert_challenge, ttl=_get_ttl())
     tls_alpn_server.update()
     return 'ok'
 
 
 @app.route('/tls-alpn/<string:domain>/<string:identifier>/certificate-and-key', methods=['PUT'])
 def tls_alpn_challenge_put_pem(domain, identifier):
-    log('Adding TLS ALPN challenge for domain {0} and identifier {1} (PEM certificate and key)'.format(domain, identifier))
+    log('Adding TLS ALPN challenge for domain {0} and identifier {1} (PEM certificate and key)', args=(domain, identifier))
     key, cert_challenge = _get_alpn_key_cert_from_pem_chain(domain, identifier, request.data)
-    cert_normal = gen_ss_cert(key, [domain], [], [])
     # Start/modify TLS-ALPN-01 challenge server
-    tls_alpn_server.add(domain, key, cert_normal, cert_challenge)
+    tls_alpn_server.add(domain, key, cert_challenge, ttl=_get_ttl())
     tls_alpn_server.update()
     return 'ok'
 
 
+@app.route('/tls-alpn', methods=['PUT'])
+def tls_alpn_challenge_batch():
+    try:
+        default_key_type = _get_key_type()
+        entries = []
+        for entry in _parse_batch(request.data):
+            key_type = str(entry.get('key-type', default_key_type))
+            if key_type not in KEY_TYPES:
+                raise ValueError('key-type must be one of {0}'.format(', '.join(KEY_TYPES)))
+            entries.append((str(entry['domain']), str(entry['identifier']), base64.standard_b64decode(entry['der-value-b64']), key_type))
+    except (ValueError, KeyError, TypeError) as e:
+        log('Invalid TLS ALPN challenge batch: {0}', args=(e, ))
+        return 'invalid batch', 400
+    start = time.monotonic()
+    try:
+        key_certs = _get_alpn_key_certs_from_der_values(entries)
+    except concurrent.futures.TimeoutError:
+        log('Generating {0} TLS ALPN challenge certificates took longer than {1} seconds', args=(len(entries), TLS_ALPN_BATCH_TIMEOUT))
+        return 'timeout', 503
+    # Start/modify TLS-ALPN-01 challenge server
+    tls_alpn_server.add_many([(entry[0], key, cert_challenge) for entry, (key, cert_challenge) in zip(entries, key_certs)], ttl=_get_ttl())
+    tls_alpn_server.update()
+    log('Added {0} TLS ALPN challenges in {1:.3f} seconds', args=(len(entries), time.monotonic() - start))
+    return 'ok'
+
+
 @app.route('/tls-alpn/<string:domain>', methods=['DELETE'])
 def tls_alpn_challenge_delete(domain):
-    log('Removing TLS ALPN challenge for domain {0}'.format(domain))
+    log('Removing TLS ALPN challenge for domain {0}', args=(domain, ))
     tls_alpn_server.remove(domain)
     tls_alpn_server.update()
     return 'ok'
@@ -203,52 +490,196 @@ def get_http_challenge(filename):
         host = host[:i]
     if host[0] == '[' and host[-1] == ']':
         host = host[1:-1]
-    if host not in challenges:
-        log('Retrieving HTTP challenge for unknown host {0}!'.format(host))
+    files = challenges.get_group(host)
+    if files is None:
+        log('Retrieving HTTP challenge for unknown host {0}!', args=(host, ))
         return 'unknown host', 404
-    if filename not in challenges[host]:
-        log('Retrieving unknown HTTP challenge {0} for host {0}!'.format(host, '/.well-known/acme-challenge/{0}'.format(filename)))
+    if filename not in files:
+        log('Retrieving unknown HTTP challenge /.well-known/acme-challenge/{1} for host {0}!', args=(host, filename))
         return 'not found', 404
-    log('Retrieving HTTP challenge {1} for host {0}'.format(host, '/.well-known/acme-challenge/{0}'.format(filename)))
-    return challenges[host][filename]
+    log('Retrieving HTTP challenge /.well-known/acme-challenge/{1} for host {0}', args=(host, filename))
+    return files[filename]
+
+
+pebble_client = PebbleClient('localhost', int(os.environ.get('PEBBLE_MANAGEMENT_PORT') or '15000'), pool_size=int(os.environ.get('PEBBLE_CONNECTION_POOL_SIZE') or '8'))
+
+
+REGISTRY.gauge('acme_pebble_client', 'Pebble management client statistics', ('stat', ),
+               callback=lambda: [((name, ), value) for name, value in sorted(pebble_client.get_stats().items())])
+
+
+def _pebble_urlopen(fragment):
+    log('(internal call to {0}{1})', args=(pebble_client.base_url, fragment), level=logging.DEBUG)
+    return pebble_client.urlopen(fragment)
+
+
+minica_cache = FileCache()
+pebble_documents = PebbleDocumentCache(
+    _pebble_urlopen,
+    revalidate_interval=float(os.environ.get('PEBBLE_CACHE_REVALIDATE_INTERVAL') or '30'),
+    log_callback=log)
+ocsp_issuer_index = IssuerIndex(
+    _pebble_urlopen, root_count=int(os.environ.get('PEBBLE_ALTERNATE_ROOTS') or '0') + 1, log_callback=log)
+REGISTRY.gauge('acme_ocsp_issuers', 'Number of indexed OCSP issuers',
+               callback=lambda: [((), len(ocsp_issuer_index))])
+ocsp_response_cache = OCSPResponseCache(
+    # Seconds during which a signed OCSP response is served without asking Pebble for the certificate status;
+    # with 0, Pebble is always asked, and the response is only re-signed if the status changed
+    lifetime=float(os.environ.get('OCSP_RESPONSE_CACHE_LIFETIME') or '0'),
+    size=int(os.environ.get('OCSP_RESPONSE_CACHE_SIZE') or '10000'),
+    # Seconds after which a cached response is signed again, so that its thisUpdate stays recent
+    max_age=float(os.environ.get('OCSP_RESPONSE_MAX_AGE') or '300'))
+REGISTRY.gauge('acme_ocsp_response_cache_entries', 'Number of cached signed OCSP responses',
+               callback=lambda: [((), len(ocsp_response_cache))])
+# Number of threads processing OCSP requests concurrently; 0 processes them on the request thread
+OCSP_WORKERS = int(os.environ.get('OCSP_WORKERS') or '8')
+ocsp_worker_pool = None
+if OCSP_WORKERS > 0:
+    # Requests beyond workers plus queue are answered with tryLater
+    ocsp_worker_pool = OCSPWorkerPool(OCSP_WORKERS, max_queue=int(os.environ.get('OCSP_MAX_QUEUE') or '64'))
+    REGISTRY.gauge('acme_ocsp_worker_pool', 'OCSP worker pool statistics', ('stat', ),
+                   callback=lambda: [((name, ), value) for name, value in sorted(ocsp_worker_pool.get_stats().items())])
+# Seconds between thisUpdate and nextUpdate of OCSP responses; 0 omits nextUpdate
+OCSP_NEXT_UPDATE = float(os.environ.get('OCSP_NEXT_UPDATE') or '0')
+ocsp_next_update = datetime.timedelta(seconds=OCSP_NEXT_UPDATE) if OCSP_NEXT_UPDATE > 0 else None
+
+crl_store = CRLStore(ocsp_issuer_index, log_callback=log)
+REGISTRY.gauge('acme_crl_entries', 'Number of revoked certificates listed in CRLs',
+               callback=lambda: [((), len(crl_store))])
+# Pebble generates new intermediates on restart, so the OCSP responder must forget the old ones;
+# the CRL store only drops the CRL of a root once the issuer index returns a different intermediate
+pebble_documents.add_invalidation_listener(ocsp_issuer_index.clear)
+pebble_documents.add_invalidation_listener(ocsp_response_cache.clear)
+
+
+def _make_cached_response(data, etag):
+    response = make_response(data)
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 
 @app.route('/root-certificate-for-acme-endpoint')
 def get_root_certificate_minica():
-    with open(os.path.join(PEBBLE_PATH, 'test', 'certs', 'pebble.minica.pem'), 'rt') as f:
-        return f.read()
-
-
-def _pebble_urlopen(fragment, *args, **kwargs):
-    ctx = ssl.create_default_context()
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    url = "https://localhost:15000{0}".format(fragment)
-    log('(internal call to {0})'.format(url))
-    return urllib.request.urlopen(url, *args, context=ctx, **kwargs)
+    return _make_cached_response(*minica_cache.get(os.path.join(PEBBLE_PATH, 'test', 'certs', 'pebble.minica.pem')))
 
 
 @app.route('/root-certificate-for-ca/<int:index>')
 def get_root_certificate_pebble(index):
-    return _pebble_urlopen("/roots/{0}".format(index)).read()
+    return _make_cached_response(*pebble_documents.get("/roots/{0}".format(index)))
 
 
 @app.route('/intermediate-certificate-for-ca/<int:index>')
 def get_intermediate_certificate_pebble(index):
-    return _pebble_urlopen("/intermediates/{0}".format(index)).read()
+    return _make_cached_response(*pebble_documents.get("/intermediates/{0}".format(index)))
+
+
+@app.route('/ca-certificate-cache', methods=['DELETE'])
+def invalidate_ca_certificate_cache():
+    log('Invalidating cached CA certificates')
+    pebble_documents.invalidate()
+    return 'ok'
+
+
+@app.route('/ocsp-response-cache', methods=['DELETE'])
+def invalidate_ocsp_response_cache():
+    serial = request.args.get('serial')
+    if serial is None:
+        log('Invalidating cached OCSP responses')
+        ocsp_response_cache.invalidate()
+    else:
+        try:
+            serial_number = int(serial, 16)
+        except ValueError:
+            return 'serial must be hexadecimal', 400
+        log('Invalidating cached OCSP responses for certificate # {0}'.format(serial_number))
+        ocsp_response_cache.invalidate(serial_number)
+    return 'ok'
 
 
 @app.route('/ocsp/<string:data>', methods=['GET'])
 def ocsp_get(data):
     log('Received OCSP GET request')
-    return get_ocsp_response(base64.urlsafe_b64decode(data), _pebble_urlopen, log=log)
+    response = get_ocsp_response(
+        base64.urlsafe_b64decode(data), _pebble_urlopen, ocsp_issuer_index,
+        log=log, response_cache=ocsp_response_cache, worker_pool=ocsp_worker_pool,
+        revocation_listener=crl_store.add_revocation, next_update=ocsp_next_update, http_caching=True)
+    return response.make_conditional(request)
 
 
 @app.route('/ocsp', methods=['POST'])
 def ocsp_post():
     log('Received OCSP POST request')
-    return get_ocsp_response(request.data, _pebble_urlopen, log=log)
+    return get_ocsp_response(
+        request.data, _pebble_urlopen, ocsp_issuer_index,
+        log=log, response_cache=ocsp_response_cache, worker_pool=ocsp_worker_pool,
+        revocation_listener=crl_store.add_revocation, next_update=ocsp_next_update)
+
+
+@app.route('/crl/<int:index>')
+def get_crl(index):
+    document = crl_store.get(index)
+    if document is None:
+        return 'not found', 404
+    data, etag, last_modified = document
+    response = make_response(data)
+    response.mimetype = 'application/pkix-crl'
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response.make_conditional(request)
+
+
+@app.route('/crl-entry/<string:serial>', methods=['PUT'])
+def update_crl_entry(serial):
+    try:
+        serial_number = int(serial, 16)
+    except ValueError:
+        return 'serial must be hexadecimal', 400
+    data = get_certificate_status(serial_number, _pebble_urlopen)
+    if data is None:
+        return 'not found', 404
+    crl_store.add_certificate_status(serial_number, data)
+    return jsonify({'status': data['Status']})
+
+
+def _warm_up_ca_certificates():
+    for root in range(ocsp_issuer_index.root_count):
+        pebble_documents.get("/roots/{0}".format(root))
+        pebble_documents.get("/intermediates/{0}".format(root))
+
+
+def _warm_up_key_pool():
+    alpn_key_pools[TLS_ALPN_KEY_TYPE].start()
+    if not alpn_key_pools[TLS_ALPN_KEY_TYPE].wait_until_full(timeout=STARTUP_TIMEOUT):
+        raise Exception('Key pool was not filled within {0} seconds'.format(STARTUP_TIMEOUT))
+
+
+# Seconds to wait for Pebble's management interface and for the key pool during startup
+STARTUP_TIMEOUT = float(os.environ.get('STARTUP_TIMEOUT') or '300')
+
+# Seconds after which failed warm-up steps are run again
+STARTUP_RETRY_INTERVAL = float(os.environ.get('STARTUP_RETRY_INTERVAL') or '30')
+
+warmup = Warmup(log_callback=partial(log, program='Warm-up'), retry_interval=STARTUP_RETRY_INTERVAL)
+warmup.add('tls-alpn-server', tls_alpn_server.start)
+warmup.add('pebble', lambda: wait_until(lambda: _pebble_urlopen('/roots/0').read(), timeout=STARTUP_TIMEOUT))
+warmup.add('ca-certificates', _warm_up_ca_certificates, requires=['pebble'])
+warmup.add('ocsp-issuers', ocsp_issuer_index.refresh, requires=['pebble'])
+warmup.add('tls-alpn-key-pool', _warm_up_key_pool)
+if dns_server.workers:
+    warmup.add('dns-workers', partial(dns_server.wait_for_workers, STARTUP_TIMEOUT))
+warmup.start()
+
+
+@app.route('/ready')
+def get_ready():
+    status = warmup.get_status()
+    if dns_server.workers:
+        # Workers which exit later are not restarted, so they are checked on every request
+        status['dns-workers'] = dns_server.get_worker_status()
+        if any(worker['state'] != 'running' for worker in status['dns-workers']):
+            status['ready'] = False
+    return jsonify(status), 200 if status['ready'] else 503
 
 
 if __name__ == "__main__":
-    app.run(debug=False, host='::', port=int(os.environ.get('CONTROLLER_PORT', 5000)))
+    app.run(debug=False, host='::', port=int(os.environ.get('CONTROLLER_PORT', 5000)), threaded=True)
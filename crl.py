@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import threading
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+
+from metrics import REGISTRY
+from ocsp import parse_revocation
+from pebble_management import make_etag
+
+
+CRL_SIGNING_SECONDS = REGISTRY.histogram('acme_crl_signing_seconds', 'Time spent signing CRLs')
+
+
+class _IssuerCRL(object):
+    __slots__ = ('intermediate', 'revoked', 'number', 'document')
+
+    def __init__(self, intermediate):
+        self.intermediate = intermediate
+        # serial number -> x509.RevokedCertificate
+        self.revoked = {}
+        self.number = 0
+        # (DER, ETag, last modified), or None if the CRL must be signed again
+        self.document = None
+
+
+class CRLStore(object):
+    '''
+    One CRL per root, listing all revocations which have been seen so far.
+
+    Revocations are added one by one with ``add_revocation()``; the CRL of the
+    affected intermediate is re-signed (with a new CRL number) the next time it
+    is requested, and served as-is until the next change, or until half of its
+    validity period has passed. When the issuer index returns a different
+    intermediate for a root (Pebble was restarted), the CRL of that root
+    starts over.
+    '''
+
+    def __init__(self, issuer_index, next_update=datetime.timedelta(days=1), log_callback=None):
+        self.issuer_index = issuer_index
+        self.next_update = next_update
+        self.log_callback = log_callback
+        self._lock = threading.Lock()
+        self._crls = {}
+
+    def _log(self, message):
+        if self.log_callback is not None:
+            self.log_callback(message)
+
+    def _get_crl(self, root, intermediate):
+        # Must be called with ``_lock`` held
+        crl = self._crls.get(root)
+        if crl is None or crl.intermediate != intermediate:
+            if crl is not None:
+                self._log('Intermediate of root {0} changed, starting a new CRL'.format(root))
+            crl = _IssuerCRL(intermediate)
+            self._crls[root] = crl
+        return crl
+
+    def add_revocation(self, intermediate, serial_number, revocation_time, reason):
+        '''
+        Records that a certificate issued by ``intermediate`` has been revoked.
+        Returns ``False`` if the intermediate is unknown.
+        '''
+        root = self.issuer_index.get_root(intermediate)
+        if root is None:
+            return False
+        if revocation_time is None:
+            # Keep the date of a revocation which has already been recorded
+            with self._lock:
+                crl = self._crls.get(root)
+                if crl is not None and crl.intermediate == intermediate and serial_number in crl.revoked:
+                    return True
+            revocation_time = datetime.datetime.now(datetime.timezone.utc)
+        builder = x509.RevokedCertificateBuilder()
+        builder = builder.serial_number(serial_number)
+        builder = builder.revocation_date(revocation_time)
+        if reason is not None and reason != x509.ReasonFlags.unspecified:
+            builder = builder.add_extension(x509.CRLReason(reason), critical=False)
+        revoked = builder.build(default_backend())
+        with self._lock:
+            crl = self._get_crl(root, intermediate)
+            current = crl.revoked.get(serial_number)
+            if current is not None and current.revocation_date_utc == revoked.revocation_date_utc:
+                return True
+            crl.revoked[serial_number] = revoked
+            crl.document = None
+        self._log('Added certificate # {0} to CRL of root {1}'.format(serial_number, root))
+        return True
+
+    def add_certificate_status(self, serial_number, data):
+        '''
+        Records a revocation from Pebble's status information of a certificate.
+        Returns ``False`` if the certificate is not revoked or its issuer is unknown.
+        '''
+        if data['Status'] != 'Revoked':
+            return False
+        certificate = x509.load_pem_x509_certificate(data['Certificate'].encode('utf-8'), backend=default_backend())
+        for root in range(self.issuer_index.root_count):
+            intermediate = self.issuer_index.get_issuer(root)[0]
+            if intermediate.subject == certificate.issuer:
+                revocation_time, revocation_reason = parse_revocation(data)
+                return self.add_revocation(intermediate, serial_number, revocation_time, revocation_reason)
+        return False
+
+    def _sign(self, crl, intermediate, intermediate_key):
+        now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        crl.number += 1
+        builder = x509.CertificateRevocationListBuilder()
+        builder = builder.issuer_name(intermediate.subject)
+        builder = builder.last_update(now)
+        builder = builder.next_update(now + self.next_update)
+        builder = builder.add_extension(x509.CRLNumber(crl.number), critical=False)
+        builder = builder.add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(intermediate.public_key()), critical=False)
+        for revoked in crl.revoked.values():
+            builder = builder.add_revoked_certificate(revoked)
+        with CRL_SIGNING_SECONDS.time():
+            document = builder.sign(intermediate_key, hashes.SHA256(), default_backend())
+        data = document.public_bytes(serialization.Encoding.DER)
+        crl.document = (data, make_etag(data), now)
+
+    def _needs_refresh(self, crl):
+        if crl.document is None:
+            return True
+        last_update = crl.document[2]
+        return datetime.datetime.now(datetime.timezone.utc) >= last_update + self.next_update / 2
+
+    def get(self, root):
+        '''
+        Returns ``(DER, ETag, last modified)`` of the CRL for a root, or ``None``
+        if there is no such root.
+        '''
+        issuer = self.issuer_index.get_issuer(root)
+        if issuer is None:
+            return None
+        intermediate, intermediate_key = issuer
+        with self._lock:
+            crl = self._get_crl(root, intermediate)
+            if self._needs_refresh(crl):
+                self._sign(crl, intermediate, intermediate_key)
+            return crl.document
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(crl.revoked) for crl in self._crls.values())
+
+
+__all__ = ['CRLStore']
@@ -1,11 +1,102 @@
 # -*- coding: utf-8 -*-
 
-from dnslib import A, TXT, QTYPE, RCODE, server
+import argparse
+import asyncio
+import collections
+import functools
+import json
+import os
+import selectors
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+from dnslib import A, TXT, QTYPE, RCODE, DNSRecord, server
+
+from challenge_store import ChallengeStore, start_sweeper
+from dns_zone import ZoneIndex, parse_records
+from metrics import REGISTRY
+
+
+DNS_QUERIES = REGISTRY.counter('acme_dns_queries_total', 'DNS queries answered', ('qtype', 'rcode'))
+DNS_RESOLVE_SECONDS = REGISTRY.histogram('acme_dns_resolve_seconds', 'Time spent resolving DNS queries', ('qtype', ))
+
+LOCALHOST_A = A("127.0.0.1")
+
+# Maximal number of CNAMEs followed for one query
+MAX_CNAME_CHAIN = 8
+
+# TXT values of a name together with the answer records built from them
+TXTRecordSet = collections.namedtuple('TXTRecordSet', ['values', 'answers'])
+
+
+def normalize_name(name):
+    name = name.lower()
+    if not name.endswith('.'):
+        name = name + '.'
+    return name
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_default_a_answer(name):
+    return server.RR(rname=name, rtype=QTYPE.A, rdata=LOCALHOST_A, ttl=10)
+
+
+def _render_zone(record):
+    return str(record.toZone("")).split('\n')
 
 
 class DNSLogger(object):
-    def __init__(self, log_callback):
+    '''
+    Logs DNS traffic and counts queries per name and type.
+
+    ``mode`` is one of ``off``, ``summary`` (one line per request and reply),
+    ``full`` (additionally dumps the records) and ``sampled`` (like ``full``,
+    but only for one out of ``sample_rate`` queries). Record dumps are only
+    rendered when they are actually written.
+    '''
+
+    MODES = ('off', 'summary', 'full', 'sampled')
+
+    # Queries for further names are counted as '<other>'
+    MAX_COUNTED_NAMES = 10000
+
+    def __init__(self, log_callback, mode='full', sample_rate=100):
+        if mode not in self.MODES:
+            raise ValueError('Unknown DNS log mode "{0}"'.format(mode))
         self.log_callback = log_callback
+        self.mode = mode
+        self.sample_rate = max(1, sample_rate)
+        self._lock = threading.Lock()
+        self._queries = 0
+        self._query_counts = {}
+
+    def get_query_counts(self, limit=None):
+        '''
+        Returns a list of ``(name, qtype, count)`` tuples, most queried first.
+        '''
+        with self._lock:
+            counts = sorted(((name, qtype, count) for (name, qtype), count in self._query_counts.items()), key=lambda entry: -entry[2])
+        return counts[:limit] if limit is not None else counts
+
+    def reset_query_counts(self):
+        with self._lock:
+            self._query_counts = {}
+
+    def _count_query(self, request):
+        key = (normalize_name(str(request.q.qname)), QTYPE[request.q.qtype])
+        with self._lock:
+            if key not in self._query_counts and len(self._query_counts) >= self.MAX_COUNTED_NAMES:
+                key = ('<other>', key[1])
+            self._query_counts[key] = self._query_counts.get(key, 0) + 1
+            self._queries += 1
+            return self._queries
+
+    def _get_detail(self, handler):
+        return getattr(handler, 'dns_log_detail', None if self.mode == 'sampled' else self.mode)
 
     def log_pass(self, *args):
         pass
@@ -17,59 +108,485 @@ class DNSLogger(object):
         pass
 
     def log_request(self, handler, request):
-        self.log_callback("DNS Request: [{0}:{1}] ({2}) <{3}> : {4}".format(handler.client_address[0], handler.client_address[1], handler.protocol, request.q.qname, QTYPE[request.q.qtype]), data=str(request.toZone("")).split('\n'))
+        index = self._count_query(request)
+        if self.mode == 'sampled':
+            handler.dns_log_detail = 'full' if (index - 1) % self.sample_rate == 0 else None
+        detail = self._get_detail(handler)
+        if detail is None or detail == 'off':
+            return
+        # Messages are passed as callables, so that they are only formatted if they are logged
+        self.log_callback(functools.partial(_format_request, handler, request), data=functools.partial(_render_zone, request) if detail == 'full' else None)
 
     def log_reply(self, handler, reply):
-        if reply.header.rcode == RCODE.NOERROR:
-            self.log_callback("DNS Reply: [{0}:{1}] ({2}) / '{3}' ({4}) / RRs: {5}".format(handler.client_address[0], handler.client_address[1], handler.protocol, reply.q.qname, QTYPE[reply.q.qtype], ",".join([QTYPE[a.rtype] for a in reply.rr])), data=str(reply.toZone("")).split('\n'))
-        else:
-            self.log_callback("DNS Reply: [{0}:{1}] ({2}) / '{3}' ({4}) / {5}".format(handler.client_address[0], handler.client_address[1], handler.protocol, reply.q.qname, QTYPE[reply.q.qtype], RCODE[reply.header.rcode]), data=str(reply.toZone("")).split('\n'))
+        detail = self._get_detail(handler)
+        if detail is None or detail == 'off':
+            return
+        self.log_callback(functools.partial(_format_reply, 'DNS Reply', handler, reply), data=functools.partial(_render_zone, reply) if detail == 'full' else None)
 
     def log_truncated(self, handler, reply):
-        self.log_callback("DNS Truncated Reply: [{0}:{1}] ({2}) / '{3}' ({4}) / RRs: {5}".format(handler.client_address[0], handler.client_address[1], handler.protocol, reply.q.qname, QTYPE[reply.q.qtype], ",".join([QTYPE[a.rtype] for a in reply.rr])), data=str(reply.toZone("")).split('\n'))
+        detail = self._get_detail(handler)
+        if detail is None or detail == 'off':
+            return
+        self.log_callback(functools.partial(_format_reply, 'DNS Truncated Reply', handler, reply), data=functools.partial(_render_zone, reply) if detail == 'full' else None)
 
     def log_error(self, handler, e):
-        self.log_callback("DNS Invalid Request: [{0}:{1}] ({2}) :: {3}".format(handler.client_address[0], handler.client_address[1], handler.protocol, e))
+        if self.mode == 'off':
+            return
+        self.log_callback(functools.partial("DNS Invalid Request: [{0}:{1}] ({2}) :: {3}".format, handler.client_address[0], handler.client_address[1], handler.protocol, e))
+
+
+def _format_request(handler, request):
+    return "DNS Request: [{0}:{1}] ({2}) <{3}> : {4}".format(handler.client_address[0], handler.client_address[1], handler.protocol, request.q.qname, QTYPE[request.q.qtype])
+
+
+def _format_reply(prefix, handler, reply):
+    if reply.header.rcode == RCODE.NOERROR:
+        result = "RRs: {0}".format(",".join([QTYPE[a.rtype] for a in reply.rr]))
+    else:
+        result = RCODE[reply.header.rcode]
+    return "{0}: [{1}:{2}] ({3}) / '{4}' ({5}) / {6}".format(prefix, handler.client_address[0], handler.client_address[1], handler.protocol, reply.q.qname, QTYPE[reply.q.qtype], result)
+
+
+class _QueryContext(object):
+    '''
+    Replaces dnslib's request handler for the asyncio engine, providing what
+    DNSLogger and resolve() expect from it.
+    '''
+
+    def __init__(self, client_address, protocol):
+        self.client_address = client_address
+        self.protocol = protocol
+
+
+class _UDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, dns_server):
+        self.dns_server = dns_server
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        reply = self.dns_server.handle_query(data, _QueryContext(addr[:2], 'udp'))
+        if reply is not None:
+            self.transport.sendto(reply, addr)
+
+
+class AsyncDNSEngine(object):
+    '''
+    Serves DNS over UDP and TCP from one asyncio event loop running on a
+    daemon thread, instead of dnslib's thread-per-request socket servers.
+    '''
+
+    TCP_IDLE_TIMEOUT = 30
+
+    def __init__(self, dns_server, address, port, reuse_port=False):
+        self.dns_server = dns_server
+        self.address = address
+        self.port = port
+        self.reuse_port = reuse_port
+        self.loop = None
+        self.thread = None
+
+    async def _start_servers(self):
+        await self.loop.create_datagram_endpoint(
+            lambda: _UDPProtocol(self.dns_server), local_addr=(self.address, self.port), family=socket.AF_INET,
+            reuse_port=self.reuse_port or None)
+        await asyncio.start_server(
+            self._handle_tcp, host=self.address, port=self.port, family=socket.AF_INET, reuse_port=self.reuse_port or None)
+
+    async def _handle_tcp(self, reader, writer):
+        context = _QueryContext(writer.get_extra_info('peername')[:2], 'tcp')
+        try:
+            while True:
+                length = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2), self.TCP_IDLE_TIMEOUT))[0]
+                data = await asyncio.wait_for(reader.readexactly(length), self.TCP_IDLE_TIMEOUT)
+                reply = self.dns_server.handle_query(data, context)
+                if reply is None:
+                    break
+                writer.write(struct.pack('!H', len(reply)) + reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def start_thread(self):
+        self.loop = asyncio.new_event_loop()
+        started = threading.Event()
+        errors = []
+
+        def run():
+            asyncio.set_event_loop(self.loop)
+            try:
+                self.loop.run_until_complete(self._start_servers())
+            except Exception as e:
+                errors.append(e)
+                return
+            finally:
+                started.set()
+            self.loop.run_forever()
+
+        self.thread = threading.Thread(target=run)
+        self.thread.daemon = True
+        self.thread.start()
+        started.wait()
+        if errors:
+            raise errors[0]
+
+
+class _ReusePortUDPServer(server.UDPServer):
+    allow_reuse_port = True
+
+
+class _ReusePortTCPServer(server.TCPServer):
+    allow_reuse_port = True
+
+
+class _WorkerProcess(object):
+    '''
+    A DNS worker process, together with the read end of the pipe on which it
+    reports that its servers are listening.
+    '''
+
+    __slots__ = ('index', 'process', 'ready_fd', 'state')
+
+    def __init__(self, index, process, ready_fd):
+        self.index = index
+        self.process = process
+        self.ready_fd = ready_fd
+        # 'starting', 'running' or 'exited'
+        self.state = 'starting'
 
 
 class DNSServer(object):
+    '''
+    DNS server answering A, AAAA, CNAME and TXT queries from the zone index and
+    the TXT challenge store.
+
+    With ``workers`` > 0, queries are not served by this process, but by that
+    many worker processes sharing the port via ``SO_REUSEPORT``. All changes
+    are applied here as well as sent to the workers as JSON lines on their
+    standard input. Each worker evicts expired TXT records on its own, and
+    keeps its own query counts, which are not reported back. Workers are not
+    restarted: one which exits is logged and reported by ``get_worker_status()``.
+    '''
+
+    # Seconds between checks whether worker processes are still alive
+    WORKER_CHECK_INTERVAL = 1
+
     def resolve(self, request, handler):
+        start = time.monotonic()
+        reply = self._resolve(request)
+        qtype = QTYPE[request.q.qtype]
+        DNS_RESOLVE_SECONDS.observe(time.monotonic() - start, qtype=qtype)
+        DNS_QUERIES.inc(qtype=qtype, rcode=RCODE[reply.header.rcode])
+        return reply
+
+    def _resolve(self, request):
         reply = request.reply()
-        if request.q.qtype == QTYPE.ANY or request.q.qtype == QTYPE.A:
-            reply.add_answer(server.RR(rname=request.q.qname, rtype=QTYPE.A, rdata=A("127.0.0.1"), ttl=10))
-        if request.q.qtype == QTYPE.ANY or request.q.qtype == QTYPE.TXT:
-            records = self.txt_records.get(str(request.q.qname), [])
-            for record in records:
-                reply.add_answer(server.RR(rname=request.q.qname, rtype=QTYPE.TXT, rdata=TXT(record), ttl=10))
+        qtype = request.q.qtype
+        # Validators may randomize the case of query names, so look up normalized names only
+        name = normalize_name(str(request.q.qname))
+        for dummy in range(MAX_CNAME_CHAIN):
+            records = self.zone.lookup(name)
+            cname = records.get(QTYPE.CNAME) if records is not None else None
+            if cname is None or qtype == QTYPE.CNAME:
+                self._add_answers(reply, name, qtype, records)
+                break
+            reply.add_answer(server.RR(rname=name, rtype=QTYPE.CNAME, rdata=cname, ttl=10))
+            name = str(cname.label)
         return reply
 
-    def __init__(self, port, log_callback=None):
+    def _add_answers(self, reply, name, qtype, records):
+        if qtype == QTYPE.ANY or qtype == QTYPE.A:
+            if records is None:
+                reply.add_answer(_get_default_a_answer(name))
+            else:
+                for rdata in records.get(QTYPE.A, ()):
+                    reply.add_answer(server.RR(rname=name, rtype=QTYPE.A, rdata=rdata, ttl=10))
+        if (qtype == QTYPE.ANY or qtype == QTYPE.AAAA) and records is not None:
+            for rdata in records.get(QTYPE.AAAA, ()):
+                reply.add_answer(server.RR(rname=name, rtype=QTYPE.AAAA, rdata=rdata, ttl=10))
+        if qtype == QTYPE.CNAME and records is not None and QTYPE.CNAME in records:
+            reply.add_answer(server.RR(rname=name, rtype=QTYPE.CNAME, rdata=records[QTYPE.CNAME], ttl=10))
+        if qtype == QTYPE.ANY or qtype == QTYPE.TXT:
+            record_set = self.txt_records.get(name, 'TXT')
+            if record_set is not None:
+                reply.add_answer(*record_set.answers)
+
+    def handle_query(self, data, handler):
+        '''
+        Parses a query, resolves it and returns the packed reply. Mirrors
+        dnslib's request handler, including its logger hooks.
+        '''
+        self.logger.log_recv(handler, data)
+        try:
+            request = DNSRecord.parse(data)
+            self.logger.log_request(handler, request)
+            reply = self.resolve(request, handler)
+            self.logger.log_reply(handler, reply)
+            rdata = reply.pack()
+        except Exception as e:
+            # Mostly DNSError for malformed queries; must not take down the event loop
+            self.logger.log_error(handler, e)
+            return None
+        self.logger.log_send(handler, rdata)
+        return rdata
+
+    def __init__(self, port, log_callback=None, ttl=None, engine='threaded', log_mode='full', log_sample_rate=100, workers=0, reuse_port=False, sweep_interval=60):
         if log_callback is None:
             def f(msg, data=None):
+                if callable(msg):
+                    msg = msg()
                 print(msg)
+                if callable(data):
+                    data = data()
                 if data is not None:
                     print(data)
 
             log_callback = f
 
-        self.txt_records = {}
+        self.txt_records = ChallengeStore(default_ttl=ttl)
+        self.zone = ZoneIndex()
         self.log_callback = log_callback
         self.port = port
-        self.logger = DNSLogger(self.log_callback)
-        self.servers = [
-            server.DNSServer(self, address="localhost", port=self.port, tcp=False, logger=self.logger),
-            server.DNSServer(self, address="localhost", port=self.port, tcp=True, logger=self.logger),
-        ]
+        self.logger = DNSLogger(self.log_callback, mode=log_mode, sample_rate=log_sample_rate)
+        self._update_lock = threading.Lock()
+        self._workers_lock = threading.Lock()
+        self.workers = []
+        if engine not in ('asyncio', 'threaded'):
+            raise ValueError('Unknown DNS server engine "{0}"'.format(engine))
+        if workers > 0:
+            self.servers = []
+            for index in range(workers):
+                self.workers.append(self._start_worker(index, ttl, engine, log_mode, log_sample_rate, sweep_interval))
+            monitor = threading.Thread(target=self._monitor_workers)
+            monitor.daemon = True
+            monitor.start()
+        elif engine == 'asyncio':
+            self.servers = [AsyncDNSEngine(self, address="127.0.0.1", port=self.port, reuse_port=reuse_port)]
+        else:
+            udp_options = dict(server=_ReusePortUDPServer) if reuse_port else {}
+            tcp_options = dict(server=_ReusePortTCPServer) if reuse_port else {}
+            self.servers = [
+                server.DNSServer(self, address="localhost", port=self.port, tcp=False, logger=self.logger, **udp_options),
+                server.DNSServer(self, address="localhost", port=self.port, tcp=True, logger=self.logger, **tcp_options),
+            ]
         for ds in self.servers:
             ds.start_thread()
 
-    def _cleanup(self, zone):
-        if not zone.endswith('.'):
-            zone = zone + '.'
-        return zone
+    def _start_worker(self, index, ttl, engine, log_mode, log_sample_rate, sweep_interval):
+        command = [
+            sys.executable, os.path.abspath(__file__), '--worker',
+            '--index', str(index),
+            '--port', str(self.port),
+            '--engine', engine,
+            '--log-mode', log_mode,
+            '--log-sample-rate', str(log_sample_rate),
+            '--sweep-interval', str(sweep_interval),
+        ]
+        if ttl:
+            command.extend(['--ttl', str(ttl)])
+        ready_fd, ready_write_fd = os.pipe()
+        command.extend(['--ready-fd', str(ready_write_fd)])
+        self.log_callback('Starting DNS worker process #{0}'.format(index))
+        try:
+            process = subprocess.Popen(command, stdin=subprocess.PIPE, pass_fds=(ready_write_fd, ))
+        finally:
+            os.close(ready_write_fd)
+        return _WorkerProcess(index, process, ready_fd)
+
+    def _monitor_workers(self):
+        while True:
+            time.sleep(self.WORKER_CHECK_INTERVAL)
+            for worker in self.workers:
+                returncode = worker.process.poll()
+                if returncode is None:
+                    continue
+                with self._workers_lock:
+                    if worker.state == 'exited':
+                        continue
+                    worker.state = 'exited'
+                self.log_callback('DNS worker process #{0} exited with code {1}; its share of queries is no longer answered'.format(
+                    worker.index, returncode))
+
+    def wait_for_workers(self, timeout):
+        '''
+        Blocks until all worker processes are listening. Raises an exception if
+        one of them has exited, or does not report within ``timeout`` seconds.
+        '''
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.state == 'exited':
+                raise Exception('DNS worker process #{0} exited with code {1}'.format(worker.index, worker.process.poll()))
+            if worker.state != 'starting':
+                continue
+            with selectors.DefaultSelector() as selector:
+                selector.register(worker.ready_fd, selectors.EVENT_READ)
+                ready = selector.select(max(deadline - time.monotonic(), 0))
+            if not ready:
+                raise Exception('DNS worker process #{0} did not start within {1} seconds'.format(worker.index, timeout))
+            # EOF means that the worker exited before its servers were listening
+            started = bool(os.read(worker.ready_fd, 64))
+            os.close(worker.ready_fd)
+            with self._workers_lock:
+                worker.state = 'running' if started and worker.state == 'starting' else 'exited'
+            if not started:
+                raise Exception('DNS worker process #{0} exited with code {1}'.format(worker.index, worker.process.wait()))
+
+    def get_worker_status(self):
+        with self._workers_lock:
+            return [
+                {
+                    'index': worker.index,
+                    'pid': worker.process.pid,
+                    'state': worker.state,
+                    'returncode': worker.process.returncode,
+                }
+                for worker in self.workers
+            ]
+
+    def _publish(self, message):
+        '''
+        Sends a change to all worker processes. Must be called with
+        ``_update_lock`` held, so that workers see changes in the same order.
+        '''
+        if not self.workers:
+            return
+        line = (json.dumps(message) + '\n').encode('utf-8')
+        for worker in self.workers:
+            if worker.state == 'exited':
+                continue
+            try:
+                worker.process.stdin.write(line)
+                worker.process.stdin.flush()
+            except (BrokenPipeError, OSError, ValueError) as e:
+                self.log_callback('Cannot send update to DNS worker process #{0}: {1}'.format(worker.index, e))
+
+    def _publish_txt_records(self, zones, ttl):
+        for zone in zones:
+            self._publish({'op': 'txt', 'zone': zone, 'values': list(self.get_txt_records(zone)), 'ttl': ttl})
+
+    def apply_update(self, message):
+        '''
+        Applies a change published by ``_publish()``; used by worker processes.
+        '''
+        if message['op'] == 'txt':
+            if message['values']:
+                self.set_txt_records(message['zone'], message['values'], ttl=message['ttl'])
+            else:
+                self.clear_txt_records(message['zone'])
+        elif message['op'] == 'zone':
+            self.update_zone(message['entries'])
+        elif message['op'] == 'zone-remove':
+            self.remove_zone(message['name'])
+        else:
+            raise ValueError('Unknown update operation "{0}"'.format(message['op']))
+
+    def _build_txt_record_set(self, zone, values):
+        values = tuple(values)
+        answers = tuple(server.RR(rname=zone, rtype=QTYPE.TXT, rdata=TXT(value), ttl=10) for value in values)
+        return TXTRecordSet(values, answers)
+
+    def get_txt_records(self, zone):
+        record_set = self.txt_records.get(normalize_name(zone), 'TXT')
+        return record_set.values if record_set is not None else ()
 
-    def set_txt_records(self, zone, values):
-        self.txt_records[self._cleanup(zone)] = values
+    def set_txt_records(self, zone, values, ttl=None):
+        zone = normalize_name(zone)
+        with self._update_lock:
+            self.txt_records.set(zone, 'TXT', self._build_txt_record_set(zone, values), ttl=ttl)
+            self._publish_txt_records([zone], ttl)
 
     def clear_txt_records(self, zone):
-        self.txt_records[self._cleanup(zone)] = []
+        zone = normalize_name(zone)
+        with self._update_lock:
+            self.txt_records.remove_group(zone)
+            self._publish_txt_records([zone], None)
+
+    def _change_txt_record_set(self, zone, set_values, add_values, remove_values, record_set):
+        values = list(set_values) if set_values is not None else list(record_set.values if record_set is not None else ())
+        for value in remove_values:
+            if value in values:
+                values.remove(value)
+        for value in add_values:
+            if value not in values:
+                values.append(value)
+        return self._build_txt_record_set(zone, values) if values else None
+
+    def update_txt_records(self, changes, ttl=None):
+        '''
+        Applies a list of ``(zone, set_values, add_values, remove_values)`` changes
+        in one step; ``set_values`` may be ``None`` to keep the current values.
+        Every record set is replaced as a whole, so queries see either the old or
+        the new values, never a mix.
+        '''
+        entries = []
+        for zone, set_values, add_values, remove_values in changes:
+            zone = normalize_name(zone)
+            entries.append((zone, 'TXT', functools.partial(
+                self._change_txt_record_set, zone, set_values, tuple(add_values), tuple(remove_values))))
+        with self._update_lock:
+            self.txt_records.modify_many(entries, ttl=ttl)
+            self._publish_txt_records(sorted(set(entry[0] for entry in entries)), ttl)
+
+    def update_zone(self, entries):
+        '''
+        Sets A, AAAA or CNAME records for a list of ``(name, records)`` pairs,
+        where ``records`` is accepted by ``parse_records()``. Raises
+        ``ValueError`` without changing anything if one of them is invalid.
+        '''
+        parsed = [(name, parse_records(records)) for name, records in entries]
+        with self._update_lock:
+            self.zone.update(parsed)
+            self._publish({'op': 'zone', 'entries': [[name, records] for name, records in entries]})
+
+    def remove_zone(self, name):
+        with self._update_lock:
+            if not self.zone.remove(name):
+                return False
+            self._publish({'op': 'zone-remove', 'name': name})
+            return True
+
+
+def _run_worker(args):
+    from log_writer import LogWriter, parse_level
+
+    log_writer = LogWriter(level=parse_level(os.environ.get('LOG_LEVEL')))
+    log_writer.start()
+    dns_server = DNSServer(
+        port=args.port,
+        log_callback=functools.partial(log_writer.log, program='DNS Server #{0}'.format(args.index)),
+        ttl=args.ttl,
+        engine=args.engine,
+        log_mode=args.log_mode,
+        log_sample_rate=args.log_sample_rate,
+        reuse_port=True)
+    if args.ready_fd is not None:
+        # Tells the parent process that the servers are listening
+        os.write(args.ready_fd, b'ready\n')
+        os.close(args.ready_fd)
+    # Workers keep their own copy of the TXT records, which must be evicted as well
+    start_sweeper({'DNS TXT records': dns_server.txt_records}, args.sweep_interval, log_callback=dns_server.log_callback)
+    # The parent process sends changes line by line; EOF means it is gone
+    for line in sys.stdin.buffer:
+        try:
+            dns_server.apply_update(json.loads(line))
+        except Exception as e:
+            dns_server.log_callback('Cannot apply update: {0}'.format(e))
+    log_writer.flush()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='DNS worker process')
+    parser.add_argument('--worker', action='store_true', required=True)
+    parser.add_argument('--index', type=int, default=0)
+    parser.add_argument('--port', type=int, default=53)
+    parser.add_argument('--ttl', type=float, default=None)
+    parser.add_argument('--engine', default='threaded')
+    parser.add_argument('--log-mode', default='full')
+    parser.add_argument('--log-sample-rate', type=int, default=100)
+    parser.add_argument('--sweep-interval', type=float, default=60)
+    parser.add_argument('--ready-fd', type=int, default=None)
+    _run_worker(parser.parse_args())
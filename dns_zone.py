@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import ipaddress
+import threading
+
+from dnslib import A, AAAA, CNAME, QTYPE
+
+
+class _Node(object):
+    __slots__ = ('children', 'records')
+
+    def __init__(self):
+        self.children = {}
+        self.records = None
+
+
+def _split_name(name):
+    '''
+    Returns the labels of a name in reversed order, i.e. starting at the TLD.
+    '''
+    name = name.lower().rstrip('.')
+    if not name:
+        return []
+    labels = name.split('.')
+    labels.reverse()
+    return labels
+
+
+def parse_records(records):
+    '''
+    Converts a dictionary like ``{"A": ["127.0.0.2"], "AAAA": ["::1"]}`` or
+    ``{"CNAME": "target.example"}`` into the record mapping stored in a
+    ``ZoneIndex``. Raises ``ValueError`` on invalid input.
+    '''
+    if not isinstance(records, dict) or not records:
+        raise ValueError('Records must be a non-empty object')
+    normalized = {}
+    for rtype, values in records.items():
+        rtype = str(rtype).upper()
+        if rtype in normalized:
+            raise ValueError('Duplicate record type "{0}"'.format(rtype))
+        normalized[rtype] = values
+    result = {}
+    for rtype, values in normalized.items():
+        if rtype == 'CNAME':
+            if len(normalized) > 1:
+                raise ValueError('CNAME cannot be combined with other records')
+            if not isinstance(values, str) or not values:
+                raise ValueError('CNAME must be a name')
+            result[QTYPE.CNAME] = CNAME(values.lower().rstrip('.') + '.')
+        elif rtype in ('A', 'AAAA'):
+            if isinstance(values, str):
+                values = [values]
+            if not isinstance(values, list):
+                raise ValueError('{0} must be a list of addresses'.format(rtype))
+            if rtype == 'A':
+                result[QTYPE.A] = tuple(A(str(ipaddress.IPv4Address(value))) for value in values)
+            else:
+                result[QTYPE.AAAA] = tuple(AAAA(str(ipaddress.IPv6Address(value))) for value in values)
+        else:
+            raise ValueError('Unsupported record type "{0}"'.format(rtype))
+    return result
+
+
+class ZoneIndex(object):
+    '''
+    Per-name A, AAAA and CNAME records, stored in a trie keyed by reversed
+    labels. Names may be wildcards like ``*.example.com``, which match names
+    below ``example.com`` that do not exist in the index (see ``lookup()``).
+
+    Lookups walk at most one node per label and do not take the lock: writers
+    only add children and replace record mappings as a whole.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._root = _Node()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def set(self, name, records):
+        '''
+        Sets the records of a name, as returned by ``parse_records()``.
+        '''
+        self.update([(name, records)])
+
+    def update(self, entries):
+        '''
+        Sets the records of many ``(name, records)`` pairs at once.
+        '''
+        with self._lock:
+            for name, records in entries:
+                node = self._root
+                for label in _split_name(name):
+                    child = node.children.get(label)
+                    if child is None:
+                        child = _Node()
+                        node.children[label] = child
+                    node = child
+                if node.records is None:
+                    self._count += 1
+                node.records = dict(records)
+
+    def remove(self, name):
+        '''
+        Removes the records of a name. Returns ``False`` if it has none.
+        '''
+        with self._lock:
+            path = []
+            node = self._root
+            for label in _split_name(name):
+                path.append((node, label))
+                node = node.children.get(label)
+                if node is None:
+                    return False
+            if node.records is None:
+                return False
+            node.records = None
+            self._count -= 1
+            # Prune nodes which no longer lead to any records
+            while path and node.records is None and not node.children:
+                parent, label = path.pop()
+                del parent.children[label]
+                node = parent
+            return True
+
+    def lookup(self, name):
+        '''
+        Returns the records for a name, or ``None``.
+
+        Wildcards follow RFC 4592: only the wildcard directly below the
+        closest existing ancestor (the closest encloser) can match. Names
+        which exist in the tree, even without records of their own, and
+        names below them are not covered by wildcards further up.
+        '''
+        node = self._root
+        for label in _split_name(name):
+            child = node.children.get(label)
+            if child is None:
+                star = node.children.get('*')
+                return star.records if star is not None else None
+            node = child
+        return node.records
+
+
+__all__ = ['ZoneIndex', 'parse_records']
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import queue
+import threading
+
+
+class KeyPool(object):
+    '''
+    Keeps up to ``size`` pre-generated private keys ready.
+
+    ``get()`` hands out a pooled key if one is available (a hit), and otherwise
+    generates one right away (a miss). A daemon thread refills the pool in the
+    background whenever keys have been taken out.
+    '''
+
+    def __init__(self, generate_key, size, name='keys', log_callback=None):
+        self.generate_key = generate_key
+        self.size = size
+        self.name = name
+        self.log_callback = log_callback
+        self._keys = queue.Queue(maxsize=max(size, 1))
+        self._refill = threading.Event()
+        self._full = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'generated': 0,
+        }
+        self.thread = None
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+    def get_stats(self):
+        with self._stats_lock:
+            result = dict(self._stats)
+        result['size'] = self.size
+        result['available'] = self._keys.qsize() if self.size > 0 else 0
+        return result
+
+    def start(self):
+        with self._start_lock:
+            if self.size <= 0 or self.thread is not None:
+                return
+            self._refill.set()
+            self.thread = threading.Thread(target=self._refill_forever)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _refill_forever(self):
+        while True:
+            self._refill.wait()
+            self._refill.clear()
+            while not self._keys.full():
+                try:
+                    key = self.generate_key()
+                except Exception as e:
+                    if self.log_callback is not None:
+                        self.log_callback('Error while generating key for {0} pool: {1}'.format(self.name, e))
+                    break
+                self._count('generated')
+                self._keys.put(key)
+            if self._keys.full():
+                self._full.set()
+
+    def wait_until_full(self, timeout=None):
+        '''
+        Blocks until the pool has been filled completely. Returns ``False`` on timeout.
+        '''
+        if self.size <= 0:
+            return True
+        return self._full.wait(timeout)
+
+    def get(self):
+        if self.size > 0:
+            try:
+                key = self._keys.get_nowait()
+                self._count('hits')
+                self._full.clear()
+                self._refill.set()
+                return key
+            except queue.Empty:
+                self._refill.set()
+        self._count('misses')
+        return self.generate_key()
+
+
+__all__ = ['KeyPool']
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import collections
+import datetime
+import logging
+import queue
+import sys
+import threading
+
+
+class LogRecord(object):
+    '''
+    A single log event. Formatting is deferred until the record is written or
+    queried: ``message`` is only formatted with ``args`` when needed, and both
+    ``message`` and ``data`` may be callables which produce the actual value.
+    '''
+
+    __slots__ = ('timestamp', 'level', 'program', 'message', 'args', 'data', '_formatted')
+
+    def __init__(self, level, program, message, args, data):
+        self.timestamp = datetime.datetime.now()
+        self.level = level
+        self.program = program
+        self.message = message
+        self.args = args
+        self.data = data
+        self._formatted = None
+
+    def get_message(self):
+        message = self.message
+        if callable(message):
+            message = message()
+        if self.args:
+            message = message.format(*self.args)
+        return message
+
+    def get_data(self):
+        data = self.data
+        if callable(data):
+            data = data()
+        if not data:
+            return []
+        if not isinstance(data, list):
+            data = [data]
+        while data and not data[-1]:
+            data = data[:-1]
+        return data
+
+    def _format(self):
+        if self._formatted is None:
+            try:
+                self._formatted = (self.get_message(), self.get_data())
+            except Exception as e:
+                self._formatted = ('Error while formatting log record: {0}'.format(e), [])
+        return self._formatted
+
+    def format(self):
+        message, data = self._format()
+        lines = ['[{0}] {1}\n'.format(self.program, message)]
+        lines.extend('[{0}] | {1}\n'.format(self.program, value) for value in data)
+        return ''.join(lines)
+
+    def as_dict(self):
+        message, data = self._format()
+        return {
+            'time': self.timestamp.isoformat(),
+            'level': logging.getLevelName(self.level),
+            'program': self.program,
+            'message': str(message),
+            'data': [str(value) for value in data],
+        }
+
+
+class LogWriter(object):
+    '''
+    Queue-backed log writer. ``log()`` only creates a record and enqueues it; a
+    background thread formats records and writes them in batches. The most
+    recent records are kept in a bounded ring buffer.
+    '''
+
+    def __init__(self, stream=None, level=logging.DEBUG, batch_size=256, buffer_size=1000):
+        self.stream = stream if stream is not None else sys.stdout
+        self.level = level
+        self.batch_size = batch_size
+        self.queue = queue.SimpleQueue()
+        self.recent = collections.deque(maxlen=buffer_size)
+        self.thread = None
+
+    def is_enabled_for(self, level):
+        return level >= self.level
+
+    def log(self, message, data=None, program='Controller', level=logging.INFO, args=()):
+        if level < self.level:
+            return
+        record = LogRecord(level, program, message, args, data)
+        self.recent.append(record)
+        self.queue.put(record)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._write_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.flush, timeout=1)
+
+    def flush(self, timeout=None):
+        '''
+        Waits until all records enqueued so far have been written.
+        '''
+        if self.thread is None:
+            return
+        event = threading.Event()
+        self.queue.put(event)
+        event.wait(timeout)
+
+    def _write_forever(self):
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+            self._write(batch)
+
+    def _write(self, batch):
+        chunks = []
+        events = []
+        for record in batch:
+            if isinstance(record, threading.Event):
+                events.append(record)
+            else:
+                chunks.append(record.format())
+        try:
+            if chunks:
+                self.stream.write(''.join(chunks))
+                self.stream.flush()
+        finally:
+            for event in events:
+                event.set()
+
+    def get_recent(self, limit=None, level=logging.DEBUG, program=None):
+        '''
+        Returns the most recent records (oldest first) as dictionaries.
+        '''
+        records = [record for record in list(self.recent) if record.level >= level and (program is None or record.program == program)]
+        if limit is not None:
+            records = records[-limit:] if limit > 0 else []
+        return [record.as_dict() for record in records]
+
+
+def parse_level(value, default=logging.DEBUG):
+    if not value:
+        return default
+    if value.isdigit():
+        return int(value)
+    level = logging.getLevelName(value.upper())
+    if not isinstance(level, int):
+        raise ValueError('Unknown log level "{0}"'.format(value))
+    return level
+
+
+__all__ = ['LogRecord', 'LogWriter', 'parse_level']
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import contextlib
+import threading
+import time
+
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label_value(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_sample(name, labelnames, labelvalues, value, extra_labels=()):
+    labels = list(zip(labelnames, labelvalues)) + list(extra_labels)
+    if labels:
+        name = '{0}{{{1}}}'.format(name, ','.join('{0}="{1}"'.format(label, _escape_label_value(str(label_value))) for label, label_value in labels))
+    return '{0} {1}'.format(name, value)
+
+
+class _Metric(object):
+    metric_type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _get_key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('Metric {0} expects labels {1}'.format(self.name, ', '.join(self.labelnames)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.documentation),
+            '# TYPE {0} {1}'.format(self.name, self.metric_type),
+        ]
+        lines.extend(self._render_samples())
+        return lines
+
+
+class Counter(_Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [_format_sample(self.name, self.labelnames, key, value) for key, value in values]
+
+
+class Gauge(_Metric):
+    '''
+    A gauge. If ``callback`` is given, it is called on every scrape and must
+    return a list of ``(labelvalues, value)`` tuples.
+    '''
+    metric_type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _render_samples(self):
+        if self.callback is not None:
+            values = [(tuple(str(label) for label in key), value) for key, value in self.callback()]
+        else:
+            with self._lock:
+                values = sorted(self._values.items())
+        return [_format_sample(self.name, self.labelnames, key, value) for key, value in values]
+
+
+class Histogram(_Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._get_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = [[0] * (len(self.buckets) + 1), 0.0]
+                self._values[key] = entry
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _render_samples(self):
+        with self._lock:
+            values = sorted((key, (list(entry[0]), entry[1])) for key, entry in self._values.items())
+        lines = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += count
+                lines.append(_format_sample(self.name + '_bucket', self.labelnames, key, cumulative, extra_labels=[('le', bound if bound != float('inf') else '+Inf')]))
+            lines.append(_format_sample(self.name + '_sum', self.labelnames, key, total))
+            lines.append(_format_sample(self.name + '_count', self.labelnames, key, cumulative))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, *args, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric {0} is already registered with another type'.format(name))
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), callback=None):
+        return self._get_or_create(Gauge, name, documentation, labelnames, callback=callback)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        '''
+        Returns all metrics in the Prometheus text exposition format.
+        '''
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        lines = []
+        for dummy, metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'REGISTRY', 'Registry']
@@ -17,9 +17,13 @@
 # You should have received a copy of the GNU General Public License
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import concurrent.futures
 import datetime
+import functools
 import json
-import os
+import threading
+import time
 import urllib
 import traceback
 
@@ -31,47 +35,214 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
 
+from metrics import REGISTRY
+from pebble_management import make_etag
 
-SAMPLE_REQUEST_CACHE = {}
 
+OCSP_REQUESTS = REGISTRY.counter('acme_ocsp_requests_total', 'OCSP requests by outcome', ('outcome', ))
+OCSP_REQUEST_SECONDS = REGISTRY.histogram('acme_ocsp_request_seconds', 'Total time spent processing OCSP requests')
+OCSP_SIGNING_SECONDS = REGISTRY.histogram('acme_ocsp_signing_seconds', 'Time spent signing OCSP responses')
+OCSP_QUEUE_WAIT_SECONDS = REGISTRY.histogram('acme_ocsp_queue_wait_seconds', 'Time OCSP requests waited for a worker')
+OCSP_RESPONSE_CACHE_LOOKUPS = REGISTRY.counter('acme_ocsp_response_cache_lookups_total', 'OCSP response cache lookups by result', ('result', ))
 
-def _get_sample_request_for_root(root, hash_algorithm, pebble_urlopen):
+HASH_ALGORITHMS = (hashes.SHA1(), hashes.SHA224(), hashes.SHA256(), hashes.SHA384(), hashes.SHA512())
+
+
+def _get_issuer_hashes(intermediate, algorithm):
+    '''
+    Returns ``(issuer name hash, issuer key hash)`` as they appear in OCSP
+    requests for certificates issued by ``intermediate``.
+    '''
+    name_hash = hashes.Hash(algorithm, backend=default_backend())
+    name_hash.update(intermediate.subject.public_bytes(default_backend()))
+    # Building a request (nothing is signed) hashes the issuer's subjectPublicKey. Its name hash
+    # is computed from the issuer field of the first argument, which is the intermediate's issuer here.
+    request = ocsp.OCSPRequestBuilder().add_certificate(intermediate, intermediate, algorithm).build()
+    return name_hash.finalize(), request.issuer_key_hash
+
+
+class IssuerIndex(object):
+    '''
+    Maps ``(issuer name hash, issuer key hash, hash algorithm name)`` of OCSP
+    requests to ``(intermediate, intermediate key)`` of all Pebble roots.
+
+    The index is built from the intermediates' subjects and public keys for all
+    of ``HASH_ALGORITHMS``. Unknown issuers trigger a rebuild, at most once every
+    ``refresh_interval`` seconds. Lookups do not take the lock: rebuilds replace
+    the whole mapping.
+    '''
+
+    def __init__(self, pebble_urlopen, root_count, refresh_interval=5, log_callback=None):
+        self.pebble_urlopen = pebble_urlopen
+        self.root_count = root_count
+        self.refresh_interval = refresh_interval
+        self.log_callback = log_callback
+        self._lock = threading.Lock()
+        self._entries = None
+        self._issuers = None
+        self._last_refresh = None
+
+    def _log(self, message):
+        if self.log_callback is not None:
+            self.log_callback(message)
+
+    def _build(self):
+        entries = {}
+        issuers = []
+        for root in range(self.root_count):
+            intermediate = x509.load_pem_x509_certificate(
+                self.pebble_urlopen("/intermediates/{0}".format(root)).read(),
+                backend=default_backend())
+            intermediate_key = serialization.load_pem_private_key(
+                self.pebble_urlopen("/intermediate-keys/{0}".format(root)).read(),
+                None,
+                backend=default_backend())
+            for algorithm in HASH_ALGORITHMS:
+                name_hash, key_hash = _get_issuer_hashes(intermediate, algorithm)
+                entries[(name_hash, key_hash, algorithm.name)] = (intermediate, intermediate_key)
+            issuers.append((intermediate, intermediate_key))
+        return entries, issuers
+
+    def refresh(self, force=True):
+        '''
+        Rebuilds the index. Unless ``force`` is set, this does nothing if the
+        index was rebuilt less than ``refresh_interval`` seconds ago.
+        '''
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_refresh is not None and now < self._last_refresh + self.refresh_interval:
+                return
+            self._last_refresh = now
+            self._entries, self._issuers = self._build()
+            self._log('Indexed OCSP issuers of {0} roots'.format(self.root_count))
+
+    def lookup(self, issuer_name_hash, issuer_key_hash, hash_algorithm):
+        '''
+        Returns ``(intermediate, intermediate key)``, or ``None`` if the issuer is unknown.
+        '''
+        cache_key = (issuer_name_hash, issuer_key_hash, hash_algorithm.name)
+        entries = self._entries
+        if entries is not None and cache_key in entries:
+            return entries[cache_key]
+        self.refresh(force=entries is None)
+        entries = self._entries
+        return entries.get(cache_key) if entries is not None else None
+
+    def get_issuer(self, root):
+        '''
+        Returns ``(intermediate, intermediate key)`` of a root, or ``None`` if there is no such root.
+        '''
+        if root < 0 or root >= self.root_count:
+            return None
+        issuers = self._issuers
+        if issuers is None:
+            self.refresh(force=True)
+            issuers = self._issuers
+        return issuers[root]
+
+    def get_root(self, intermediate):
+        '''
+        Returns the index of the root an intermediate belongs to, or ``None``.
+        '''
+        for root, issuer in enumerate(self._issuers or ()):
+            if issuer[0] == intermediate:
+                return root
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._entries = None
+            self._issuers = None
+            self._last_refresh = None
+
+    def __len__(self):
+        entries = self._entries
+        return len(entries) // len(HASH_ALGORITHMS) if entries is not None else 0
+
+
+class OCSPResponseCache(object):
     '''
-    Returns an OCSP sample request for this root, together with the intermediate certificate and its key.
+    Signed OCSP responses for nonce-less requests, keyed by
+    ``(issuer name hash, issuer key hash, serial, hash algorithm)``.
+
+    Within ``lifetime`` seconds of signing, a response is served without
+    asking Pebble. After that (and always with a lifetime of 0), Pebble is
+    asked for the certificate status, and the signed response is only reused
+    if the status did not change. Responses are signed again once their
+    thisUpdate is ``max_age`` seconds old, or once half of their validity
+    period has passed if they have a nextUpdate. At most ``size`` responses
+    are kept.
     '''
-    cache_key = (root, hash_algorithm.name)
-    if cache_key in SAMPLE_REQUEST_CACHE:
-        return SAMPLE_REQUEST_CACHE[cache_key]
 
-    # Get hold of intermediate certificate with key
-    intermediate = x509.load_pem_x509_certificate(
-        pebble_urlopen("/intermediates/{0}".format(root)).read(),
-        backend=default_backend())
-    intermediate_key = serialization.load_pem_private_key(
-        pebble_urlopen("/intermediate-keys/{0}".format(root)).read(),
-        None,
-        backend=default_backend())
+    def __init__(self, lifetime=0, size=10000, max_age=300):
+        self.lifetime = lifetime
+        self.size = size
+        self.max_age = datetime.timedelta(seconds=max_age)
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+
+    def _needs_refresh(self, response):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        this_update = response.this_update_utc
+        if now >= this_update + self.max_age:
+            return True
+        next_update = response.next_update_utc
+        return next_update is not None and now >= this_update + (next_update - this_update) / 2
+
+    def get_fresh(self, cache_key):
+        '''
+        Returns the cached response if it was signed less than ``lifetime`` seconds ago.
+        '''
+        if not self.lifetime:
+            return None
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or entry[2] + self.lifetime <= time.monotonic() or self._needs_refresh(entry[1]):
+                return None
+            self._entries.move_to_end(cache_key)
+            return entry[1]
+
+    def get_for_status(self, cache_key, status):
+        '''
+        Returns the cached response if it was signed for the same certificate status.
+        Otherwise the entry is dropped.
+        '''
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            if entry[0] != status or self._needs_refresh(entry[1]):
+                del self._entries[cache_key]
+                return None
+            self._entries.move_to_end(cache_key)
+            return entry[1]
 
-    one_day = datetime.timedelta(1, 0, 0)
-    builder = x509.CertificateBuilder()
-    builder = builder.subject_name(intermediate.subject)
-    builder = builder.issuer_name(intermediate.subject)
-    builder = builder.not_valid_before(datetime.datetime.today() - one_day)
-    builder = builder.not_valid_after(datetime.datetime.today() + one_day)
-    builder = builder.serial_number(x509.random_serial_number())
-    builder = builder.public_key(intermediate.public_key())
-    certificate = builder.sign(
-        private_key=intermediate_key,
-        algorithm=hashes.SHA256(),
-        backend=default_backend())
+    def put(self, cache_key, status, response):
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[cache_key] = (status, response, time.monotonic())
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
 
-    req = ocsp.OCSPRequestBuilder()
-    req = req.add_certificate(certificate, intermediate, hash_algorithm)
-    req = req.build()
+    def invalidate(self, serial_number=None):
+        '''
+        Drops all cached responses for a serial number, or all responses.
+        '''
+        with self._lock:
+            if serial_number is None:
+                self._entries.clear()
+                return
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[2] == serial_number]:
+                del self._entries[cache_key]
 
-    result = req, intermediate, intermediate_key
-    SAMPLE_REQUEST_CACHE[cache_key] = result
-    return result
+    def clear(self):
+        self.invalidate()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
 
 
 RECOVATION_REASONS = {
@@ -86,7 +257,40 @@ RECOVATION_REASONS = {
 }
 
 
-def _get_ocsp_response(data, pebble_urlopen, log):
+def _format_serial(serial_number):
+    serial_hex = hex(serial_number)[2:]
+    if len(serial_hex) % 2 == 1:
+        serial_hex = '0' + serial_hex
+    return serial_hex
+
+
+def get_certificate_status(serial_number, pebble_urlopen):
+    '''
+    Returns Pebble's status information for a certificate, or ``None`` if Pebble does not know it.
+    '''
+    try:
+        url = pebble_urlopen("/cert-status-by-serial/{0}".format(_format_serial(serial_number)))
+    except urllib.error.HTTPError as e:
+        if e.code == 404:
+            return None
+        raise
+    return json.loads(url.read())
+
+
+def parse_revocation(data):
+    '''
+    Returns revocation time and reason from Pebble's status information of a revoked certificate.
+    '''
+    revoked_at = data.get('RevokedAt')
+    if revoked_at is not None:
+        revoked_at = ' '.join(revoked_at.split(' ')[:2])  # remove time zones
+        if '.' in revoked_at:
+            revoked_at = revoked_at[:revoked_at.index('.')]  # remove milli- or nanoseconds
+        revoked_at = datetime.datetime.strptime(revoked_at, '%Y-%m-%d %H:%M:%S')
+    return revoked_at, RECOVATION_REASONS.get(data.get('Reason'), x509.ReasonFlags.unspecified)
+
+
+def _get_ocsp_response(data, pebble_urlopen, issuer_index, log, response_cache=None, revocation_listener=None, next_update=None):
     try:
         ocsp_request = ocsp.load_der_ocsp_request(data)
     except Exception:
@@ -94,7 +298,7 @@ def _get_ocsp_response(data, pebble_urlopen, log):
         return ocsp.OCSPResponseBuilder.build_unsuccessful(
             ocsp.OCSPResponseStatus.MALFORMED_REQUEST)
 
-    log('OCSP request for certificate # {0}'.format(ocsp_request.serial_number))
+    log(functools.partial('OCSP request for certificate # {0}'.format, ocsp_request.serial_number))
 
     # Process possible extensions
     nonce = None
@@ -107,50 +311,55 @@ def _get_ocsp_response(data, pebble_urlopen, log):
                 ocsp.OCSPResponseStatus.MALFORMED_REQUEST)
 
     # Determine issuer
-    root_count = int(os.environ.get('PEBBLE_ALTERNATE_ROOTS') or '0') + 1
-    for root in range(root_count):
-        req, intermediate, intermediate_key = _get_sample_request_for_root(
-            root, ocsp_request.hash_algorithm, pebble_urlopen)
-        if req.issuer_key_hash == ocsp_request.issuer_key_hash and req.issuer_name_hash == ocsp_request.issuer_name_hash:
-            log('Identified intermediate certificate {0}'.format(intermediate.subject))
-            break
-        intermediate = None
-        intermediate_key = None
-    if intermediate is None or intermediate_key is None:
+    issuer = issuer_index.lookup(ocsp_request.issuer_name_hash, ocsp_request.issuer_key_hash, ocsp_request.hash_algorithm)
+    if issuer is None:
         log(ocsp_request.issuer_key_hash, ocsp_request.issuer_name_hash)
         log('Cannot identify intermediate certificate')
         return ocsp.OCSPResponseBuilder.build_unsuccessful(
             ocsp.OCSPResponseStatus.UNAUTHORIZED)
+    intermediate, intermediate_key = issuer
+    log(functools.partial('Identified intermediate certificate {0}'.format, intermediate.subject))
 
-    serial_hex = hex(ocsp_request.serial_number)[2:]
-    if len(serial_hex) % 2 == 1:
-        serial_hex = '0' + serial_hex
-    try:
-        url = pebble_urlopen("/cert-status-by-serial/{0}".format(serial_hex))
-    except urllib.error.HTTPError as e:
-        if e.code == 404:
-            log('Unknown certificate with # {0}'.format(ocsp_request.serial_number))
-            return ocsp.OCSPResponseBuilder.build_unsuccessful(
-                ocsp.OCSPResponseStatus.UNAUTHORIZED)
-        raise
+    # Responses to requests with nonce are unique and cannot be cached
+    cache_key = None
+    if response_cache is not None and nonce is None:
+        cache_key = (
+            ocsp_request.issuer_name_hash,
+            ocsp_request.issuer_key_hash,
+            ocsp_request.serial_number,
+            ocsp_request.hash_algorithm.name,
+        )
+        response = response_cache.get_fresh(cache_key)
+        if response is not None:
+            OCSP_RESPONSE_CACHE_LOOKUPS.inc(result='hit')
+            log(functools.partial('Serving cached OCSP response for certificate # {0}'.format, ocsp_request.serial_number))
+            return response
 
-    data = json.loads(url.read())
-    log('Pebble result on certificate:', json.dumps(data, sort_keys=True, indent=2))
+    data = get_certificate_status(ocsp_request.serial_number, pebble_urlopen)
+    if data is None:
+        log('Unknown certificate with # {0}'.format(ocsp_request.serial_number))
+        return ocsp.OCSPResponseBuilder.build_unsuccessful(
+            ocsp.OCSPResponseStatus.UNAUTHORIZED)
+    log('Pebble result on certificate:', functools.partial(json.dumps, data, sort_keys=True, indent=2))
+
+    status = (data['Status'], data.get('Reason'), data.get('RevokedAt'))
+    if cache_key is not None:
+        response = response_cache.get_for_status(cache_key, status)
+        if response is not None:
+            OCSP_RESPONSE_CACHE_LOOKUPS.inc(result='revalidated')
+            log(functools.partial('Serving cached OCSP response for certificate # {0}, status is unchanged'.format, ocsp_request.serial_number))
+            return response
+        OCSP_RESPONSE_CACHE_LOOKUPS.inc(result='miss')
 
     cert = x509.load_pem_x509_certificate(
         data['Certificate'].encode('utf-8'), backend=default_backend())
 
-    now = datetime.datetime.now()
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
     if data['Status'] == 'Revoked':
         cert_status = ocsp.OCSPCertStatus.REVOKED
-        revoked_at = data.get('RevokedAt')
-        if revoked_at is not None:
-            revoked_at = ' '.join(revoked_at.split(' ')[:2])  # remove time zones
-            if '.' in revoked_at:
-                revoked_at = revoked_at[:revoked_at.index('.')]  # remove milli- or nanoseconds
-            revoked_at = datetime.datetime.strptime(revoked_at, '%Y-%m-%d %H:%M:%S')
-        revocation_time = revoked_at,
-        revocation_reason = RECOVATION_REASONS.get(data.get('Reason'), x509.ReasonFlags.unspecified)
+        revocation_time, revocation_reason = parse_revocation(data)
+        if revocation_listener is not None:
+            revocation_listener(intermediate, ocsp_request.serial_number, revocation_time, revocation_reason)
     elif data['Status'] == 'Valid':
         cert_status = ocsp.OCSPCertStatus.GOOD
         revocation_time = None
@@ -167,7 +376,7 @@ def _get_ocsp_response(data, pebble_urlopen, log):
         algorithm=ocsp_request.hash_algorithm,
         cert_status=cert_status,
         this_update=now,
-        next_update=None,
+        next_update=now + next_update if next_update else None,
         revocation_time=revocation_time,
         revocation_reason=revocation_reason)
     response = response.responder_id(
@@ -175,16 +384,148 @@ def _get_ocsp_response(data, pebble_urlopen, log):
         intermediate)
     if nonce is not None:
         response = response.add_extension(x509.OCSPNonce(nonce), False)
-    return response.sign(intermediate_key, hashes.SHA256())
+    with OCSP_SIGNING_SECONDS.time():
+        response = response.sign(intermediate_key, hashes.SHA256())
+    if cache_key is not None:
+        response_cache.put(cache_key, status, response)
+    return response
+
+
+def _get_outcome(response):
+    if response.response_status != ocsp.OCSPResponseStatus.SUCCESSFUL:
+        return response.response_status.name.lower()
+    return response.certificate_status.name.lower()
 
 
-def get_ocsp_response(data, pebble_urlopen, log=lambda *args: print(args)):
+class OCSPWorkerPool(object):
+    '''
+    Bounded pool of threads which process OCSP requests.
+
+    At most ``workers`` requests are processed at once, and at most
+    ``max_queue`` more wait for a worker. Requests beyond that are rejected
+    right away, so that bursts get ``tryLater`` instead of timing out.
+    '''
+
+    def __init__(self, workers, max_queue):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='ocsp')
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._busy = 0
+        self._rejected = 0
+
+    def _run(self, function, submitted):
+        with self._lock:
+            self._queued -= 1
+            self._busy += 1
+        OCSP_QUEUE_WAIT_SECONDS.observe(time.monotonic() - submitted)
+        try:
+            return function()
+        finally:
+            with self._lock:
+                self._busy -= 1
+            self._slots.release()
+
+    def run(self, function):
+        '''
+        Runs ``function`` in a worker and returns its result. Returns ``None``
+        without calling it if the pool is saturated.
+        '''
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._rejected += 1
+            return None
+        with self._lock:
+            self._queued += 1
+        try:
+            future = self._executor.submit(self._run, function, time.monotonic())
+        except Exception:
+            with self._lock:
+                self._queued -= 1
+            self._slots.release()
+            raise
+        return future.result()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'queued': self._queued,
+                'busy': self._busy,
+                'rejected': self._rejected,
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+            }
+
+
+def _process_ocsp_request(data, pebble_urlopen, issuer_index, log, response_cache, revocation_listener, next_update):
     try:
-        response = _get_ocsp_response(data, pebble_urlopen, log=log)
+        return _get_ocsp_response(
+            data, pebble_urlopen, issuer_index, log=log, response_cache=response_cache, revocation_listener=revocation_listener,
+            next_update=next_update)
     except Exception as e:
         log('Error while processing OCSP request: {0}'.format(e), traceback.format_exc())
-        response = ocsp.OCSPResponseBuilder.build_unsuccessful(
+        return ocsp.OCSPResponseBuilder.build_unsuccessful(
             ocsp.OCSPResponseStatus.INTERNAL_ERROR)
-    return Response(
-        response.public_bytes(serialization.Encoding.DER),
-        mimetype='application/ocsp-response')
+
+
+def _set_caching_headers(http_response, response, data):
+    '''
+    Adds RFC 5019 caching headers to the HTTP response for an OCSP response.
+    '''
+    if response.response_status != ocsp.OCSPResponseStatus.SUCCESSFUL:
+        http_response.cache_control.no_store = True
+        return
+    http_response.set_etag(make_etag(data))
+    http_response.last_modified = response.this_update_utc
+    next_update = response.next_update_utc
+    if next_update is None:
+        http_response.cache_control.max_age = 0
+        http_response.cache_control.must_revalidate = True
+        return
+    max_age = int((next_update - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    http_response.expires = next_update
+    http_response.cache_control.max_age = max(max_age, 0)
+    http_response.cache_control.public = True
+    http_response.cache_control.no_transform = True
+    http_response.cache_control.must_revalidate = True
+
+
+def _print_log(message, data=None):
+    # Messages and data may be callables, so that they are only formatted when logged
+    print(message() if callable(message) else message)
+    if data is not None:
+        print(data() if callable(data) else data)
+
+
+def get_ocsp_response(data, pebble_urlopen, issuer_index, log=None, response_cache=None, worker_pool=None,
+                      revocation_listener=None, next_update=None, http_caching=False):
+    '''
+    Processes an OCSP request and returns the HTTP response.
+
+    ``next_update`` is a ``datetime.timedelta`` after which responses expire, or
+    ``None``. With ``http_caching``, the HTTP response gets ``Cache-Control``,
+    ``ETag``, ``Expires`` and ``Last-Modified`` headers, so that it can be
+    passed through ``make_conditional()``.
+    '''
+    if log is None:
+        log = _print_log
+    start = time.monotonic()
+    process = functools.partial(
+        _process_ocsp_request, data, pebble_urlopen, issuer_index, log, response_cache, revocation_listener, next_update)
+    if worker_pool is None:
+        response = process()
+    else:
+        response = worker_pool.run(process)
+        if response is None:
+            log('Too many concurrent OCSP requests, answering with tryLater')
+            response = ocsp.OCSPResponseBuilder.build_unsuccessful(
+                ocsp.OCSPResponseStatus.TRY_LATER)
+    OCSP_REQUESTS.inc(outcome=_get_outcome(response))
+    OCSP_REQUEST_SECONDS.observe(time.monotonic() - start)
+    data = response.public_bytes(serialization.Encoding.DER)
+    http_response = Response(data, mimetype='application/ocsp-response')
+    if http_caching:
+        _set_caching_headers(http_response, response, data)
+    return http_response
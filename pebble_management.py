@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+
+import hashlib
+import http.client
+import io
+import os
+import queue
+import ssl
+import threading
+import time
+import urllib.error
+
+
+def make_etag(data):
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+class PebbleResponse(object):
+    '''
+    Fully read response of a management call. Provides the parts of the
+    ``urllib.request.urlopen()`` result interface which are used here.
+    '''
+
+    def __init__(self, url, status, reason, headers, data, connect_time, request_time):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+        self.connect_time = connect_time
+        self.request_time = request_time
+
+    def getcode(self):
+        return self.status
+
+    def read(self):
+        return self.data
+
+
+class PebbleClient(object):
+    '''
+    HTTPS client for Pebble's management interface. Keeps a pool of idle
+    keep-alive connections and uses one SSL context for all of them, so that
+    most calls do not need a new TLS handshake.
+    '''
+
+    def __init__(self, host='localhost', port=15000, pool_size=8, timeout=30):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.base_url = 'https://{0}:{1}'.format(host, port)
+        self.ssl_context = ssl.create_default_context()
+        self.ssl_context.check_hostname = False
+        self.ssl_context.verify_mode = ssl.CERT_NONE
+        self._pool = queue.LifoQueue(maxsize=pool_size)
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'connections': 0,
+            'connect_seconds': 0.0,
+            'requests': 0,
+            'reused_connections': 0,
+            'request_seconds': 0.0,
+        }
+
+    def _count(self, **values):
+        with self._stats_lock:
+            for name, value in values.items():
+                self._stats[name] += value
+
+    def get_stats(self):
+        '''
+        Returns counters and accumulated connect and request times.
+        '''
+        with self._stats_lock:
+            result = dict(self._stats)
+        result['idle_connections'] = self._pool.qsize()
+        return result
+
+    def _connect(self):
+        connection = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self.ssl_context)
+        start = time.monotonic()
+        connection.connect()
+        elapsed = time.monotonic() - start
+        self._count(connections=1, connect_seconds=elapsed)
+        return connection, elapsed
+
+    def _release(self, connection):
+        try:
+            self._pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def request(self, path, method='GET'):
+        '''
+        Sends a request and returns a ``PebbleResponse``. A pooled connection
+        which turns out to have been closed by Pebble is replaced once.
+        '''
+        for attempt in range(2):
+            try:
+                connection = self._pool.get_nowait()
+                connect_time = 0.0
+            except queue.Empty:
+                connection, connect_time = self._connect()
+            start = time.monotonic()
+            try:
+                connection.request(method, path)
+                response = connection.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.BadStatusLine):
+                connection.close()
+                if connect_time or attempt > 0:
+                    raise
+                continue
+            except Exception:
+                connection.close()
+                raise
+            request_time = time.monotonic() - start
+            self._count(requests=1, request_seconds=request_time, reused_connections=0 if connect_time else 1)
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            return PebbleResponse(
+                self.base_url + path, response.status, response.reason, response.msg, data, connect_time, request_time)
+
+    def urlopen(self, path):
+        '''
+        Like ``urllib.request.urlopen()``, raises ``urllib.error.HTTPError`` for
+        error status codes.
+        '''
+        response = self.request(path)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(response.url, response.status, response.reason, response.headers, io.BytesIO(response.data))
+        return response
+
+
+class PebbleDocumentCache(object):
+    '''
+    In-memory cache for documents served by Pebble's management interface,
+    like ``/roots/<index>`` and ``/intermediates/<index>``.
+
+    Pebble creates new roots and intermediates every time it starts. Once
+    ``revalidate_interval`` seconds have passed since the last check, the next
+    access refetches ``/roots/0``; if it changed (or Pebble cannot be reached),
+    Pebble has been restarted and all entries are dropped.
+    '''
+
+    REFERENCE_PATH = '/roots/0'
+
+    def __init__(self, pebble_urlopen, revalidate_interval=30, log_callback=None):
+        self.pebble_urlopen = pebble_urlopen
+        self.revalidate_interval = revalidate_interval
+        self.log_callback = log_callback
+        self._lock = threading.Lock()
+        self._documents = {}
+        self._validated = None
+        self._invalidation_listeners = []
+
+    def add_invalidation_listener(self, callback):
+        '''
+        Registers a callback which is called without arguments whenever the
+        cache is invalidated.
+        '''
+        self._invalidation_listeners.append(callback)
+
+    def invalidate(self):
+        with self._lock:
+            self._documents = {}
+            self._validated = None
+        for callback in self._invalidation_listeners:
+            callback()
+
+    def _fetch(self, path):
+        data = self.pebble_urlopen(path).read()
+        return data, make_etag(data)
+
+    def _revalidate(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._validated is not None and now - self._validated < self.revalidate_interval:
+                return
+            # Mark as validated right away so that concurrent requests do not all revalidate
+            self._validated = now
+            reference = self._documents.get(self.REFERENCE_PATH)
+        try:
+            current = self._fetch(self.REFERENCE_PATH)
+        except Exception:
+            self.invalidate()
+            raise
+        if reference is not None and reference[1] != current[1]:
+            if self.log_callback is not None:
+                self.log_callback('Pebble roots changed, invalidating cached certificates')
+            self.invalidate()
+        with self._lock:
+            self._documents[self.REFERENCE_PATH] = current
+            self._validated = now
+
+    def get(self, path):
+        '''
+        Returns a tuple ``(data, etag)`` for the document at ``path``.
+        '''
+        self._revalidate()
+        with self._lock:
+            result = self._documents.get(path)
+        if result is None:
+            result = self._fetch(path)
+            with self._lock:
+                self._documents[path] = result
+        return result
+
+
+class FileCache(object):
+    '''
+    Caches file contents until the file's modification time or size changes.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+
+    def get(self, path):
+        '''
+        Returns a tuple ``(data, etag)`` for the file at ``path``.
+        '''
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._files.get(path)
+        if entry is not None and entry[0] == version:
+            return entry[1]
+        with open(path, 'rb') as f:
+            data = f.read()
+        result = data, make_etag(data)
+        with self._lock:
+            self._files[path] = (version, result)
+        return result
+
+
+__all__ = ['FileCache', 'PebbleClient', 'PebbleDocumentCache', 'PebbleResponse', 'make_etag']
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Minimal local stand-in for Pebble's management interface, so that the
+controller can be exercised without Pebble (for example by benchmark.py).
+
+Serves ``/roots/<index>``, ``/intermediates/<index>``,
+``/intermediate-keys/<index>`` and ``/cert-status-by-serial/<serial>``.
+'''
+
+import argparse
+import datetime
+import http.server
+import json
+import os
+import re
+import ssl
+import tempfile
+import threading
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
+from cryptography.x509.oid import NameOID
+
+
+def _generate_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+
+
+def _create_certificate(subject_cn, public_key, issuer_name, issuer_key, ca=False, domains=None, days=365):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = x509.CertificateBuilder()
+    builder = builder.subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject_cn)]))
+    builder = builder.issuer_name(issuer_name or x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject_cn)]))
+    builder = builder.not_valid_before(now - datetime.timedelta(days=1))
+    builder = builder.not_valid_after(now + datetime.timedelta(days=days))
+    builder = builder.serial_number(x509.random_serial_number())
+    builder = builder.public_key(public_key)
+    builder = builder.add_extension(x509.BasicConstraints(ca=ca, path_length=0 if ca else None), critical=True)
+    if domains:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(domain) for domain in domains]), critical=False)
+    return builder.sign(private_key=issuer_key, algorithm=hashes.SHA256(), backend=default_backend())
+
+
+def _pem(certificate):
+    return certificate.public_bytes(serialization.Encoding.PEM)
+
+
+def _format_serial(serial_number):
+    serial_hex = hex(serial_number)[2:]
+    if len(serial_hex) % 2 == 1:
+        serial_hex = '0' + serial_hex
+    return serial_hex
+
+
+class PebbleStandIn(object):
+    def __init__(self, host='localhost', port=15000, roots=1):
+        self.host = host
+        self.port = port
+        self.roots = []
+        self.intermediates = []
+        self.intermediate_keys = []
+        for index in range(roots):
+            root_key = _generate_key()
+            root = _create_certificate('Pebble Stand-In Root CA {0}'.format(index), root_key.public_key(), None, root_key, ca=True)
+            intermediate_key = _generate_key()
+            intermediate = _create_certificate(
+                'Pebble Stand-In Intermediate CA {0}'.format(index), intermediate_key.public_key(), root.subject, root_key, ca=True)
+            self.roots.append(root)
+            self.intermediates.append(intermediate)
+            self.intermediate_keys.append(intermediate_key)
+        self._lock = threading.Lock()
+        self._certificates = {}
+        self.server = None
+        self.thread = None
+
+    def issue_certificate(self, domain, root=0):
+        '''
+        Issues a leaf certificate for ``domain`` and records it as valid.
+        '''
+        key = ec.generate_private_key(ec.SECP256R1(), backend=default_backend())
+        certificate = _create_certificate(
+            domain, key.public_key(), self.intermediates[root].subject, self.intermediate_keys[root], domains=[domain], days=90)
+        with self._lock:
+            self._certificates[_format_serial(certificate.serial_number)] = {
+                'Certificate': _pem(certificate).decode('utf-8'),
+                'Status': 'Valid',
+                'Serial': _format_serial(certificate.serial_number),
+            }
+        return certificate
+
+    def revoke_certificate(self, certificate, reason=0):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            status = self._certificates[_format_serial(certificate.serial_number)]
+            status['Status'] = 'Revoked'
+            status['Reason'] = reason
+            status['RevokedAt'] = now.strftime('%Y-%m-%d %H:%M:%S.%f +0000 UTC')
+
+    def _get_document(self, path):
+        match = re.fullmatch(r'/(roots|intermediates|intermediate-keys)/([0-9]+)', path)
+        if match:
+            index = int(match.group(2))
+            if index >= len(self.roots):
+                return None
+            if match.group(1) == 'roots':
+                return _pem(self.roots[index])
+            if match.group(1) == 'intermediates':
+                return _pem(self.intermediates[index])
+            return self.intermediate_keys[index].private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption())
+        match = re.fullmatch(r'/cert-status-by-serial/([0-9a-fA-F]+)', path)
+        if match:
+            with self._lock:
+                status = self._certificates.get(match.group(1).lower())
+                if status is not None:
+                    return json.dumps(status).encode('utf-8')
+        return None
+
+    def _create_ssl_context(self):
+        key = _generate_key()
+        certificate = _create_certificate(self.host, key.public_key(), None, key, domains=[self.host])
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        # load_cert_chain() only accepts files
+        with tempfile.TemporaryDirectory() as directory:
+            cert_path = os.path.join(directory, 'cert.pem')
+            key_path = os.path.join(directory, 'key.pem')
+            with open(cert_path, 'wb') as f:
+                f.write(_pem(certificate))
+            with open(key_path, 'wb') as f:
+                f.write(key.private_bytes(
+                    serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()))
+            context.load_cert_chain(cert_path, key_path)
+        return context
+
+    def start(self):
+        standin = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                data = standin._get_document(self.path)
+                if data is None:
+                    data = b'not found'
+                    self.send_response(404)
+                else:
+                    self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.server.socket = self._create_ssl_context().wrap_socket(self.server.socket, server_side=True)
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the Pebble management interface')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=15000)
+    parser.add_argument('--roots', type=int, default=1, help='number of roots (1 + PEBBLE_ALTERNATE_ROOTS)')
+    args = parser.parse_args()
+    standin = PebbleStandIn(host=args.host, port=args.port, roots=args.roots)
+    standin.start()
+    print('Pebble management stand-in listening on https://{0}:{1}'.format(args.host, standin.port))
+    standin.thread.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import io
+import os
+import sys
+
+import pytest
+
+# The controller's modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakePebble(object):
+    '''
+    Serves ``/intermediates/<n>`` and ``/intermediate-keys/<n>`` of freshly
+    generated CAs, like Pebble's management interface.
+    '''
+
+    def __init__(self, root_count):
+        self.documents = {}
+        self.issuers = []
+        for root in range(root_count):
+            self.new_intermediate(root)
+
+    def new_intermediate(self, root):
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.x509.oid import NameOID
+
+        # Intermediates are signed by a root, so that their subject and issuer differ
+        root_key = ec.generate_private_key(ec.SECP256R1())
+        root_name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Fake root {0}'.format(root))])
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Fake intermediate {0}'.format(root))])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        builder = x509.CertificateBuilder()
+        builder = builder.subject_name(name).issuer_name(root_name).public_key(key.public_key())
+        builder = builder.serial_number(x509.random_serial_number())
+        builder = builder.not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1))
+        builder = builder.add_extension(x509.BasicConstraints(ca=True, path_length=0), critical=True)
+        certificate = builder.sign(root_key, hashes.SHA256())
+        self.documents['/intermediates/{0}'.format(root)] = certificate.public_bytes(serialization.Encoding.PEM)
+        self.documents['/intermediate-keys/{0}'.format(root)] = key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+        if root < len(self.issuers):
+            self.issuers[root] = (certificate, key)
+        else:
+            self.issuers.append((certificate, key))
+        return certificate, key
+
+    def issue(self, root, serial_number):
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import ec
+
+        intermediate, intermediate_key = self.issuers[root]
+        now = datetime.datetime.now(datetime.timezone.utc)
+        builder = x509.CertificateBuilder()
+        builder = builder.subject_name(x509.Name([])).issuer_name(intermediate.subject)
+        builder = builder.public_key(ec.generate_private_key(ec.SECP256R1()).public_key())
+        builder = builder.serial_number(serial_number)
+        builder = builder.not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1))
+        return builder.sign(intermediate_key, hashes.SHA256())
+
+    def urlopen(self, fragment):
+        return io.BytesIO(self.documents[fragment])
+
+
+@pytest.fixture
+def fake_pebble():
+    pytest.importorskip('cryptography')
+    return FakePebble(root_count=2)
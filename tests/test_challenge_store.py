@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+import challenge_store
+from challenge_store import ChallengeStore
+
+
+class _Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(challenge_store, 'time', clock)
+    return clock
+
+
+def test_remove_many_is_all_or_nothing():
+    store = ChallengeStore()
+    store.update([('a.example', 'x', 1), ('a.example', 'y', 2), ('b.example', 'z', 3)])
+    assert store.remove_many([('a.example', 'x'), ('b.example', 'missing')]) == [('b.example', 'missing')]
+    assert len(store) == 3
+    assert store.remove_many([('a.example', 'x'), ('b.example', 'z')]) == []
+    assert store.get_group('a.example') == {'y': 2}
+    assert store.get_group('b.example') is None
+
+
+def test_removing_last_entry_drops_group():
+    store = ChallengeStore()
+    store.set('a.example', 'x', 1)
+    assert store.remove('a.example', 'x')
+    assert not store.remove('a.example', 'x')
+    assert store.group_count() == 0
+    assert 'a.example' not in store
+
+
+def test_modify_many_removes_entries_and_groups_on_none():
+    store = ChallengeStore()
+    store.update([('a.example', 'x', 1), ('b.example', 'y', 2)])
+    store.modify_many([
+        ('a.example', 'x', lambda value: value + 10),
+        ('b.example', 'y', lambda value: None),
+        ('c.example', 'z', lambda value: 'new' if value is None else 'old'),
+    ])
+    assert store.get('a.example', 'x') == 11
+    assert 'b.example' not in store
+    assert store.get('c.example', 'z') == 'new'
+    assert store.group_count() == 2
+
+
+def test_expired_entries_are_invisible(clock):
+    store = ChallengeStore(default_ttl=10)
+    store.set('a.example', 'x', 1)
+    store.set('a.example', 'y', 2, ttl=30)
+    clock.now += 20
+    assert store.get('a.example', 'x') is None
+    assert store.get_group('a.example') == {'y': 2}
+    assert store.remove_many([('a.example', 'x')]) == [('a.example', 'x')]
+    clock.now += 20
+    assert 'a.example' not in store
+
+
+def test_modify_many_sees_expired_entries_as_missing(clock):
+    store = ChallengeStore(default_ttl=10)
+    store.set('a.example', 'x', 1)
+    clock.now += 20
+    seen = []
+    store.modify_many([('a.example', 'x', lambda value: seen.append(value) or 2)])
+    assert seen == [None]
+    assert store.get('a.example', 'x') == 2
+
+
+def test_sweep_removes_expired_entries_and_empty_groups(clock):
+    store = ChallengeStore(default_ttl=10)
+    store.update([('a.example', 'x', 1), ('b.example', 'y', 2)])
+    store.set('b.example', 'z', 3, ttl=0)
+    clock.now += 20
+    assert store.sweep() == 2
+    assert store.group_count() == 1
+    assert len(store) == 1
+    assert store.get('b.example', 'z') == 3
+    assert store.sweep() == 0
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+import pytest
+
+pytest.importorskip('cryptography')
+pytest.importorskip('flask')
+
+from cryptography import x509  # noqa: E402
+
+from crl import CRLStore  # noqa: E402
+from ocsp import IssuerIndex  # noqa: E402
+
+
+REVOKED_AT = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+
+def _store(fake_pebble):
+    index = IssuerIndex(fake_pebble.urlopen, root_count=2)
+    index.refresh()
+    return index, CRLStore(index)
+
+
+def _load(document):
+    return x509.load_der_x509_crl(document[0])
+
+
+def test_crl_lists_revocations_of_its_root_only(fake_pebble):
+    _, store = _store(fake_pebble)
+    intermediate, intermediate_key = fake_pebble.issuers[0]
+    assert store.add_revocation(intermediate, 17, REVOKED_AT, x509.ReasonFlags.key_compromise)
+    crl = _load(store.get(0))
+    assert crl.is_signature_valid(intermediate_key.public_key())
+    assert crl.issuer == intermediate.subject
+    revoked = crl.get_revoked_certificate_by_serial_number(17)
+    assert revoked.revocation_date_utc == REVOKED_AT
+    assert revoked.extensions.get_extension_for_class(x509.CRLReason).value.reason == x509.ReasonFlags.key_compromise
+    assert len(_load(store.get(1))) == 0
+    assert store.get(2) is None
+
+
+def test_crl_is_only_signed_again_after_changes(fake_pebble):
+    _, store = _store(fake_pebble)
+    intermediate = fake_pebble.issuers[0][0]
+    first = store.get(0)
+    assert store.get(0) is first
+    store.add_revocation(intermediate, 17, REVOKED_AT, None)
+    second = store.get(0)
+    assert second is not first
+    assert _load(second).extensions.get_extension_for_class(x509.CRLNumber).value.crl_number == 2
+    # Recording the same revocation again does not change the CRL
+    store.add_revocation(intermediate, 17, REVOKED_AT, None)
+    assert store.get(0) is second
+
+
+def test_revocation_without_time_keeps_recorded_date(fake_pebble):
+    _, store = _store(fake_pebble)
+    intermediate = fake_pebble.issuers[0][0]
+    store.add_revocation(intermediate, 17, REVOKED_AT, None)
+    document = store.get(0)
+    assert store.add_revocation(intermediate, 17, None, None)
+    assert store.get(0) is document
+    assert store.add_revocation(intermediate, 18, None, None)
+    assert len(_load(store.get(0))) == 2
+
+
+def test_crl_is_signed_again_after_half_of_its_validity(fake_pebble):
+    _, store = _store(fake_pebble)
+    document = store.get(0)
+    assert store.get(0) is document
+    # Pretend that the CRL was signed half a validity period ago
+    stale = document[:2] + (document[2] - store.next_update / 2, )
+    store._crls[0].document = stale
+    fresh = store.get(0)
+    assert fresh is not stale
+    assert _load(fresh).extensions.get_extension_for_class(x509.CRLNumber).value.crl_number == 2
+
+
+def test_crl_starts_over_when_intermediate_changes(fake_pebble):
+    index, store = _store(fake_pebble)
+    store.add_revocation(fake_pebble.issuers[0][0], 17, REVOKED_AT, None)
+    assert len(store) == 1
+    # A transient refresh of the index with the same intermediates keeps the CRL
+    index.clear()
+    index.refresh()
+    assert len(_load(store.get(0))) == 1
+    intermediate, intermediate_key = fake_pebble.new_intermediate(0)
+    index.clear()
+    index.refresh()
+    crl = _load(store.get(0))
+    assert len(crl) == 0
+    assert crl.is_signature_valid(intermediate_key.public_key())
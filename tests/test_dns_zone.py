@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+pytest.importorskip('dnslib')
+
+from dnslib import A, QTYPE  # noqa: E402
+
+from dns_zone import ZoneIndex, parse_records  # noqa: E402
+
+
+def _index(entries):
+    index = ZoneIndex()
+    index.update([(name, parse_records(records)) for name, records in entries.items()])
+    return index
+
+
+def _a(records):
+    return [str(record) for record in records[QTYPE.A]] if records is not None else None
+
+
+def _addresses(*addresses):
+    return [str(A(address)) for address in addresses]
+
+
+def test_parse_records_record_types_are_case_insensitive():
+    records = parse_records({'a': ['127.0.0.2'], 'aaaa': '::1'})
+    assert set(records) == {QTYPE.A, QTYPE.AAAA}
+
+
+@pytest.mark.parametrize('records', [
+    {'CNAME': 't.example', 'A': ['1.2.3.4']},
+    {'CNAME': 't.example', 'a': ['1.2.3.4']},
+    {'cname': 't.example', 'AAAA': ['::1']},
+])
+def test_parse_records_rejects_cname_with_other_records(records):
+    with pytest.raises(ValueError):
+        parse_records(records)
+
+
+def test_parse_records_rejects_duplicate_record_types():
+    with pytest.raises(ValueError):
+        parse_records({'A': ['1.2.3.4'], 'a': ['1.2.3.5']})
+
+
+def test_lookup_exact_entry_wins_over_wildcard():
+    index = _index({'*.example': {'A': ['127.0.0.2']}, 'a.example': {'A': ['127.0.0.3']}})
+    assert _a(index.lookup('a.example')) == _addresses('127.0.0.3')
+    assert _a(index.lookup('b.example')) == _addresses('127.0.0.2')
+    assert _a(index.lookup('c.b.example')) == _addresses('127.0.0.2')
+
+
+def test_lookup_closest_wildcard_wins():
+    index = _index({'*.example': {'A': ['127.0.0.2']}, '*.x.example': {'A': ['127.0.0.3']}})
+    assert _a(index.lookup('a.x.example')) == _addresses('127.0.0.3')
+    assert _a(index.lookup('a.b.x.example')) == _addresses('127.0.0.3')
+    assert _a(index.lookup('a.example')) == _addresses('127.0.0.2')
+
+
+def test_lookup_existing_names_are_not_covered_by_wildcards_further_up():
+    # y.example exists as an empty non-terminal, so it is the closest encloser
+    # of all names below it, and *.example does not apply to any of them
+    index = _index({'*.example': {'A': ['127.0.0.2']}, 'x.y.example': {'A': ['127.0.0.3']}})
+    assert index.lookup('y.example') is None
+    assert index.lookup('z.y.example') is None
+    assert index.lookup('z.x.y.example') is None
+    assert _a(index.lookup('x.y.example')) == _addresses('127.0.0.3')
+    assert _a(index.lookup('other.example')) == _addresses('127.0.0.2')
+
+
+def test_remove_prunes_empty_non_terminals():
+    index = _index({'*.example': {'A': ['127.0.0.2']}, 'x.y.example': {'A': ['127.0.0.3']}})
+    assert index.remove('x.y.example')
+    assert len(index) == 1
+    assert _a(index.lookup('y.example')) == _addresses('127.0.0.2')
+    assert not index.remove('x.y.example')
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+import pytest
+
+pytest.importorskip('cryptography')
+pytest.importorskip('flask')
+
+from cryptography.x509 import ocsp  # noqa: E402
+
+from ocsp import HASH_ALGORITHMS, IssuerIndex, OCSPResponseCache  # noqa: E402
+
+
+class _Response(object):
+    def __init__(self, age, validity=None):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.this_update_utc = now - datetime.timedelta(seconds=age)
+        self.next_update_utc = self.this_update_utc + datetime.timedelta(seconds=validity) if validity is not None else None
+
+
+KEY = (b'name hash', b'key hash', 1, 'sha1')
+
+
+def test_response_without_next_update_is_reused_until_max_age():
+    cache = OCSPResponseCache(max_age=300)
+    response = _Response(age=10)
+    cache.put(KEY, 'good', response)
+    assert cache.get_for_status(KEY, 'good') is response
+    cache.put(KEY, 'good', _Response(age=400))
+    assert cache.get_for_status(KEY, 'good') is None
+
+
+def test_response_with_next_update_is_refreshed_after_half_its_validity():
+    cache = OCSPResponseCache(max_age=3600)
+    cache.put(KEY, 'good', _Response(age=10, validity=60))
+    assert cache.get_for_status(KEY, 'good') is not None
+    cache.put(KEY, 'good', _Response(age=40, validity=60))
+    assert cache.get_for_status(KEY, 'good') is None
+
+
+def test_changed_status_drops_entry():
+    cache = OCSPResponseCache()
+    cache.put(KEY, 'good', _Response(age=0))
+    assert cache.get_for_status(KEY, 'revoked') is None
+    assert cache.get_for_status(KEY, 'good') is None
+    assert len(cache) == 0
+
+
+def test_get_fresh_honours_lifetime_and_max_age():
+    assert OCSPResponseCache(lifetime=0).get_fresh(KEY) is None
+    cache = OCSPResponseCache(lifetime=60, max_age=300)
+    response = _Response(age=0)
+    cache.put(KEY, 'good', response)
+    assert cache.get_fresh(KEY) is response
+    cache.put(KEY, 'good', _Response(age=400))
+    assert cache.get_fresh(KEY) is None
+
+
+def test_invalidate_serial_number():
+    cache = OCSPResponseCache()
+    other = (b'name hash', b'key hash', 2, 'sha1')
+    cache.put(KEY, 'good', _Response(age=0))
+    cache.put(other, 'good', _Response(age=0))
+    cache.invalidate(1)
+    assert cache.get_for_status(KEY, 'good') is None
+    assert cache.get_for_status(other, 'good') is not None
+
+
+def test_size_is_bounded():
+    cache = OCSPResponseCache(size=2)
+    for serial in range(3):
+        cache.put((b'name hash', b'key hash', serial, 'sha1'), 'good', _Response(age=0))
+    assert len(cache) == 2
+    assert cache.get_for_status((b'name hash', b'key hash', 0, 'sha1'), 'good') is None
+
+
+@pytest.mark.parametrize('algorithm', HASH_ALGORITHMS, ids=lambda algorithm: algorithm.name)
+def test_issuer_index_matches_ocsp_requests(fake_pebble, algorithm):
+    index = IssuerIndex(fake_pebble.urlopen, root_count=2)
+    for root, (intermediate, _) in enumerate(fake_pebble.issuers):
+        certificate = fake_pebble.issue(root, 1000 + root)
+        request = ocsp.OCSPRequestBuilder().add_certificate(certificate, intermediate, algorithm).build()
+        assert index.lookup(request.issuer_name_hash, request.issuer_key_hash, request.hash_algorithm)[0] == intermediate
+        assert index.get_root(intermediate) == root
+
+
+def test_issuer_index_does_not_match_unknown_issuer(fake_pebble):
+    index = IssuerIndex(fake_pebble.urlopen, root_count=2)
+    assert index.lookup(b'x' * 20, b'y' * 20, HASH_ALGORITHMS[0]) is None
+    assert index.get_root(fake_pebble.issue(0, 1)) is None
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import traceback
+
+
+class Warmup(object):
+    '''
+    Runs named startup steps one after another in a daemon thread, and keeps
+    track of their state (``pending``, ``running``, ``ready``, ``failed`` or
+    ``skipped``) and duration.
+
+    A step is skipped if one of the steps it ``requires`` did not become ready.
+    With a ``retry_interval``, failed and skipped steps are run again after
+    that many seconds, until all steps are ready.
+    '''
+
+    def __init__(self, log_callback=None, retry_interval=None):
+        self.log_callback = log_callback
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._steps = []
+        self._status = {}
+        self.thread = None
+
+    def _log(self, message, data=None):
+        if self.log_callback is not None:
+            self.log_callback(message, data)
+
+    def add(self, name, function, requires=()):
+        with self._lock:
+            self._steps.append((name, function, tuple(requires)))
+            self._status[name] = {
+                'state': 'pending',
+                'seconds': None,
+                'error': None,
+            }
+
+    def _set_status(self, name, **values):
+        with self._lock:
+            self._status[name].update(values)
+
+    def _run_step(self, name, function, requires):
+        with self._lock:
+            missing = [required for required in requires if self._status[required]['state'] != 'ready']
+        if missing:
+            self._set_status(name, state='skipped', error='requires {0}'.format(', '.join(missing)))
+            self._log('Skipping warm-up of {0}, since {1} is not ready'.format(name, ', '.join(missing)))
+            return
+        self._set_status(name, state='running')
+        start = time.monotonic()
+        try:
+            function()
+        except Exception as e:
+            self._set_status(name, state='failed', seconds=time.monotonic() - start, error=str(e))
+            self._log('Warm-up of {0} failed: {1}'.format(name, e), traceback.format_exc())
+            return
+        seconds = time.monotonic() - start
+        self._set_status(name, state='ready', seconds=seconds, error=None)
+        self._log('Warmed up {0} in {1:.3f} seconds'.format(name, seconds))
+
+    def _run(self):
+        steps = list(self._steps)
+        while True:
+            for name, function, requires in steps:
+                self._run_step(name, function, requires)
+            with self._lock:
+                steps = [step for step in self._steps if self._status[step[0]]['state'] != 'ready']
+            if not steps or not self.retry_interval:
+                return
+            self._log('Retrying warm-up of {0} in {1} seconds'.format(', '.join(step[0] for step in steps), self.retry_interval))
+            time.sleep(self.retry_interval)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get_status(self):
+        with self._lock:
+            subsystems = dict((name, dict(status)) for name, status in self._status.items())
+        return {
+            'ready': all(status['state'] == 'ready' for status in subsystems.values()),
+            'subsystems': subsystems,
+        }
+
+
+def wait_until(function, timeout, interval=0.5):
+    '''
+    Calls ``function`` until it does not raise an exception, and returns its
+    result. Re-raises the last exception after ``timeout`` seconds.
+    '''
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return function()
+        except Exception:
+            if time.monotonic() >= deadline:
+                raise
+        time.sleep(interval)
+
+
+__all__ = ['Warmup', 'wait_until']